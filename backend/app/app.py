@@ -1,18 +1,24 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, aclosing
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 from typing import List, Optional
 import traceback
 from app import config
-from PIL import Image
 import os, io
 import zipfile
+import json
 import asyncio
 from app.core.pipeline import MangaTranslationPipeline
+from app.core.jobs import create_job_backend, JobQueueFullError
+from app.core.result_cache import ResultCache, inference_backends_id
+from app.core.uploads import spool_upload
+from app.core.output_writer import available_output_formats, format_for_extension
+from app.utils import metrics, debug
+from app.utils.debug import debug_print
 
 
 async def main():
@@ -37,7 +43,14 @@ async def lifespan(app: FastAPI):
     try:
         pipeline = MangaTranslationPipeline()
         pipelines['pipeline'] = pipeline
-        print("Startup Completed")
+
+        if config.RESULT_CACHE_ENABLED:
+            pipelines['result_cache'] = ResultCache()
+
+        jobs = create_job_backend(run_translation_job, discard_batch)
+        await jobs.start()
+        pipelines['jobs'] = jobs
+        print("Startup Completed, models are loading in the background")
     except Exception as e:
         print("Start up failed")
         raise e
@@ -45,6 +58,13 @@ async def lifespan(app: FastAPI):
     yield
 
     print("Shutting down server")
+    if 'jobs' in pipelines:
+        await pipelines['jobs'].stop()
+    if 'result_cache' in pipelines:
+        pipelines['result_cache'].close()
+    if 'pipeline' in pipelines:
+        await pipelines['pipeline'].translator.aclose()
+        pipelines['pipeline'].close()
     pipelines.clear()
     
 app = FastAPI(lifespan=lifespan)
@@ -64,91 +84,380 @@ app.mount("/translated", StaticFiles(directory="output"), name="static")
 
 @app.get("/health")
 async def check_health(request: Request):
-    print(f"Checked Health")
+    debug_print(f"Checked Health")
     return {"status": "ok"}
 
 
+# Readiness, unlike /health this only succeeds once every model is loaded and warmed up
+@app.get("/ready")
+async def check_ready():
+    if 'pipeline' not in pipelines:
+        return JSONResponse(content={'ready': False, 'models': {}}, status_code=503)
+
+    model_loader = pipelines['pipeline'].model_loader
+    ready = model_loader.is_ready()
+    return JSONResponse(content={'ready': ready, 'models': model_loader.stats()}, status_code=200 if ready else 503)
+
+
 @app.post("/translate-images/")
 async def translate_images_in_batch(
     request: Request,
     files: List[UploadFile] = File(...),
-    translator: Optional[str] = Form("gemini")
+    translator: Optional[str] = Form("gemini"),
+    output_format: Optional[str] = Form("original")
 ):
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
 
-    if 'pipeline' not in pipelines:
-        raise HTTPException(status_code=500, detail="Server is still initializing")
+    check_pipeline()
 
     print(f"Received {len(files)} image(s) with translator: {translator}")
-    
+
+    batch = await prepare_batch(files, translator, output_format)
+
+    if batch['images']:
+        # Goes through the job queue like /jobs/ so it gets the same admission control, but waits for the result
+        job = submit_translation_job(batch)
+        job = await pipelines['jobs'].wait(job.id)
+
+        if job.status != 'done':
+            print(f"Error during image processing: {job.error}")
+            raise HTTPException(status_code=500, detail=f"Something went wrong and inpaint process failed")
+
+        translated_file_names = job.result
+    else:
+        # Every page was already translated before, no need to queue anything
+        translated_file_names = [batch['file_names'][index] for index in range(batch['count'])]
+
+    json_res = build_images_response(request, translated_file_names)
+    debug_print(json_res)
+
+    headers = server_timing_headers(job.timings) if batch['images'] else None
+    return JSONResponse(content=json_res, status_code=201, media_type='application/json', headers=headers)
+
+
+# Queue a batch and return right away with the id to poll
+@app.post("/jobs/")
+async def submit_job(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    translator: Optional[str] = Form("gemini"),
+    output_format: Optional[str] = Form("original")
+):
+    if not files:
+        raise HTTPException(status_code=400, detail="No files provided")
+
+    check_pipeline()
+
+    batch = await prepare_batch(files, translator, output_format)
+    job = submit_translation_job(batch)
+    print(f"Queued job {job.id} with {len(files)} image(s) and translator: {translator}")
+
+    content = job.to_dict()
+    content['statusUrl'] = f'{request.base_url}jobs/{job.id}'
+    content['resultUrl'] = f'{request.base_url}jobs/{job.id}/result'
+    return JSONResponse(content=content, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job = get_job_or_404(job_id)
+    return job.to_dict()
+
+
+# Same response as /translate-images/ once the job is done, 202 with the job status while it's still queued or running
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(request: Request, job_id: str):
+    job = get_job_or_404(job_id)
+
+    if job.status == 'failed':
+        raise HTTPException(status_code=500, detail=f"Job failed: {job.error}")
+
+    if job.status != 'done':
+        return JSONResponse(content=job.to_dict(), status_code=202)
+
+    return JSONResponse(content=build_images_response(request, job.result), status_code=200, headers=server_timing_headers(job.timings))
+
+
+# Same as /translate-images/ but streams one NDJSON line per page as soon as that page is saved, instead of waiting for the whole batch
+# Each line is either {"index", "imageUrl", "name"} or {"index", "error"}, and the last one is {"done": true, "total", "timings"}
+@app.post("/translate-images/stream/")
+async def translate_images_stream(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    translator: Optional[str] = Form("gemini"),
+    output_format: Optional[str] = Form("original")
+):
+    if not files:
+        raise HTTPException(status_code=400, detail="No files provided")
+
+    check_pipeline()
+
+    print(f"Received {len(files)} image(s) to stream with translator: {translator}")
+
+    # The uploads have to be spooled before the response starts, they are closed once the job is done with them
+    batch = await prepare_batch(files, translator, output_format)
+
+    # Goes through the job queue like the other endpoints, so it shares their worker slots, model threads and 429
+    job = None
+    if batch['images']:
+        batch['page_events'] = asyncio.Queue()
+        job = submit_translation_job(batch)
+
+    async def page_events():
+        # Pages we already translated before go out right away
+        for image_index, name in batch['file_names'].items():
+            yield json.dumps(build_page_event(request, image_index, name)) + "\n"
+
+        if job is not None:
+            pending_indexes = set(batch['images'])
+            while True:
+                event = await next_page_event(batch['page_events'], job)
+                if event is None:
+                    break
+                pending_indexes.discard(event['index'])
+                if 'error' not in event:
+                    event = build_page_event(request, event['index'], event['name'])
+                yield json.dumps(event) + "\n"
+
+            # Pages the job never got to, because it failed or the server is shutting down
+            for image_index in sorted(pending_indexes):
+                yield json.dumps({'index': image_index, 'error': "Something went wrong and inpaint process failed"}) + "\n"
+
+        # Headers are long gone by the end of a stream, the stage timings go in the last line instead
+        done_event = {'done': True, 'total': batch['count']}
+        if config.SERVER_TIMING_ENABLED and job is not None:
+            done_event['timings'] = job.timings.to_dict()
+        yield json.dumps(done_event) + "\n"
+
+    return StreamingResponse(page_events(), media_type='application/x-ndjson')
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    stats = {}
+    if 'result_cache' in pipelines:
+        stats['resultCache'] = pipelines['result_cache'].stats()
+    if 'pipeline' in pipelines and pipelines['pipeline'].stage_cache is not None:
+        stats['stageCache'] = pipelines['pipeline'].stage_cache.stats()
+    if 'pipeline' in pipelines and pipelines['pipeline'].translator.memory is not None:
+        stats['translationMemory'] = pipelines['pipeline'].translator.memory.stats()
+    return stats
+
+
+@app.get("/metrics")
+async def get_metrics():
+    content, content_type = metrics.render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+@app.get("/detection/stats")
+async def get_detection_stats():
+    if 'pipeline' not in pipelines or pipelines['pipeline'].detection_batcher is None:
+        return {}
+    return {'batcher': pipelines['pipeline'].detection_batcher.stats()}
+
+
+# Next page event a streaming job put in its queue, None once the job is over and every event was read
+async def next_page_event(events, job):
+    get_event = asyncio.ensure_future(events.get())
+    job_finished = asyncio.ensure_future(job.finished.wait())
+    try:
+        await asyncio.wait([get_event, job_finished], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        job_finished.cancel()
+        if not get_event.done():
+            get_event.cancel()
+
+    if get_event.done() and not get_event.cancelled():
+        return get_event.result()
+    # The job is over, whatever it queued before finishing still has to go out
+    return events.get_nowait() if not events.empty() else None
+
+
+# Pages are saved one by one as the pipeline finishes them, so only the pages inside the pipeline are ever decoded at the same time
+# For the stream endpoint every page is also announced in batch['page_events'], as {'index', 'name'} or {'index', 'error'}
+# Other jobs fail on the first page that fails, a stream job keeps going and reports the error of that page
+async def run_translation_job(batch, executor):
     pipeline = pipelines['pipeline']
+    events = batch.get('page_events')
 
-    image_list = []
-    original_filename = []
-    original_file_extensions = []
+    # Only the pages that were not in the result cache when the batch came in
+    missing_indexes = sorted(batch['images'])
+    missing_images = [batch['images'][index] for index in missing_indexes]
+    file_names = dict(batch['file_names'])
 
-    for file in files:
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
+    try:
+        with debug.debug_request():
+            async with aclosing(pipeline.translate_images_stream(missing_images, batch['translator'], executor)) as pages:
+                async for position, final_image, error, failed_lines in pages:
+                    image_index = missing_indexes[position]
+
+                    if error is not None:
+                        if events is None:
+                            raise error
+                        print(f"Error during image processing of page {image_index}: {error}")
+                        events.put_nowait({'index': image_index, 'error': "Something went wrong and inpaint process failed"})
+                        continue
+
+                    # A page with untranslated bubbles is still returned, but a retry has to translate it again instead of hitting the cache
+                    if failed_lines:
+                        print(f"Page {image_index} has {failed_lines} untranslated bubble(s), it won't be cached")
+                    file_names[image_index] = await save_translated_page(batch, image_index, final_image, cacheable=failed_lines == 0)
+                    if events is not None:
+                        events.put_nowait({'index': image_index, 'name': file_names[image_index]})
+    finally:
+        discard_batch(batch)
+
+    return [file_names.get(index) for index in range(batch['count'])]
+
+
+# Pages are accepted while the models are still loading, they wait for them inside the pipeline
+# Only a model that failed to load turns requests away
+def check_pipeline():
+    if 'pipeline' not in pipelines:
+        raise HTTPException(status_code=503, detail="Server is still initializing", headers={'Retry-After': '10'})
 
-        filename, extension = os.path.splitext(file.filename)
-        image_list.append(image)
-        original_filename.append(filename)
-        original_file_extensions.append(extension.lstrip('.'))
+    failed_models = pipelines['pipeline'].model_loader.failed_models()
+    if failed_models:
+        raise HTTPException(status_code=503, detail=f"Model(s) failed to load: {', '.join(failed_models)}")
 
-    loop = asyncio.get_running_loop()
+
+def submit_translation_job(batch):
+    if 'jobs' not in pipelines:
+        raise HTTPException(status_code=500, detail="Server is still initializing")
 
     try:
-        all_text_and_coord_data = await loop.run_in_executor(
-            None,
-            pipeline.detect_and_extract_text,
-            image_list
-        )
-
-        all_translated_data = await pipeline.translate_all_texts(
-            all_text_and_coord_data,
-            translator
-        )
-
-        processed_images = await loop.run_in_executor(
-            None,
-            pipeline.inpaint_and_render, 
-            all_translated_data,
-            image_list
-        )
-
-        #processed_images = await pipeline.process_images(image_list)
+        return pipelines['jobs'].submit(batch)
+    except JobQueueFullError as e:
+        discard_batch(batch)
+        raise HTTPException(status_code=429, detail=str(e), headers={'Retry-After': '10'})
 
-    except Exception as e:
-        print(f"Error during image processing: {e}")
-        raise HTTPException(status_code=500, detail=f"Something went wrong and inpaint process failed")
-    
-    translated_file_names = save_images(processed_images, original_filename, original_file_extensions)
-    
+
+def server_timing_headers(timings):
+    if not config.SERVER_TIMING_ENABLED:
+        return None
+    value = timings.server_timing()
+    return {'Server-Timing': value} if value else None
+
+
+def get_job_or_404(job_id):
+    job = pipelines['jobs'].get(job_id) if 'jobs' in pipelines else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def build_images_response(request, translated_file_names):
     json_res = {}
     for index, name in enumerate(translated_file_names):
         json_res[f'image_{index}'] ={
             'imageUrl': f'{request.base_url}translated/{name}',
             'name': name,
         }
-    
-    print(json_res)
+    return json_res
+
+
+def build_page_event(request, image_index, name):
+    return {
+        'index': image_index,
+        'imageUrl': f'{request.base_url}translated/{name}',
+        'name': name,
+    }
+
+
+# Spool the uploads of a request to disk, pages found in the result cache are copied to their output name and never decoded
+# batch['images'] maps the index of each page that still has to be translated to its SpooledPage, the pipeline decodes it when it gets to it
+# batch['file_names'] maps the index of each page that is already done to its output file name
+async def prepare_batch(files, translator, output_format='original'):
+    output_format = (output_format or 'original').lower()
+    if output_format != 'original' and output_format not in available_output_formats():
+        raise HTTPException(status_code=400, detail=f"Unsupported output_format {output_format}, use one of: original, {', '.join(available_output_formats())}")
+
+    batch = {
+        'translator': translator,
+        'count': len(files),
+        'images': {},
+        'file_names': {},
+        'filenames': [],
+        'extensions': [],
+        'output_extensions': [],
+        'content_hashes': [],
+    }
+
+    try:
+        for image_index, file in enumerate(files):
+            page = await spool_upload(file)
+
+            filename, extension = os.path.splitext(file.filename)
+            batch['filenames'].append(filename)
+            batch['extensions'].append(extension.lstrip('.'))
+            batch['output_extensions'].append(output_extension(extension.lstrip('.'), output_format))
+            batch['content_hashes'].append(page.content_hash)
+
+            cached_name = await restore_cached_page(batch, image_index)
+            if cached_name:
+                batch['file_names'][image_index] = cached_name
+                page.close()
+                continue
+
+            batch['images'][image_index] = page
+    except Exception:
+        discard_batch(batch)
+        raise
+
+    return batch
+
+
+# Remove the spooled uploads of a batch once nothing is going to read them anymore
+def discard_batch(batch):
+    for page in batch['images'].values():
+        page.close()
+
+
+# Extension the translated page is saved with, the one of the upload unless the client asked for another format
+def output_extension(upload_extension, output_format):
+    if output_format != 'original':
+        return output_format
+    # Uploads in a format Pillow can't write come back as PNG
+    return upload_extension if format_for_extension(upload_extension) else 'png'
+
+
+def result_cache_key(batch, image_index):
+    cache = pipelines['result_cache']
+    # The output extension is part of the key since the cached file is encoded in that format, the backends since they change the pixels slightly
+    return cache.make_key(batch['content_hashes'][image_index], batch['translator'], batch['output_extensions'][image_index].lower(), inference_backends_id())
+
+
+# Copy the cached translation of a page to its output name, returns that name or None if the page is not cached
+# The index lookup and the copy both run off the event loop
+async def restore_cached_page(batch, image_index):
+    if 'result_cache' not in pipelines:
+        return None
+
+    cached_path = await asyncio.to_thread(pipelines['result_cache'].get, result_cache_key(batch, image_index))
+    if not cached_path:
+        return None
+
+    final_file_name = translated_file_name(batch['filenames'][image_index], batch['output_extensions'][image_index])
+    await pipelines['pipeline'].output_writer.save_copy(cached_path, final_file_name)
+    return final_file_name
+
+
+# Encode a translated page off the event loop and keep a copy of it in the result cache, unless it's not cacheable
+async def save_translated_page(batch, image_index, img, cacheable=True):
+    final_file_name = translated_file_name(batch['filenames'][image_index], batch['output_extensions'][image_index])
+    output_path = await pipelines['pipeline'].output_writer.save(img, final_file_name)
 
-    return JSONResponse(content=json_res, status_code=201, media_type='application/json')
+    if cacheable and 'result_cache' in pipelines:
+        await asyncio.to_thread(pipelines['result_cache'].put, result_cache_key(batch, image_index), output_path)
 
+    return final_file_name
 
 
-def save_images(processed_images, original_filename, original_file_extensions):
-    translated_file_names = []
-    for img, orig_name, orig_ext in zip(processed_images, original_filename, original_file_extensions):
-        final_file_name = f'{orig_name}_translated.{orig_ext}'
-        output_path = os.path.join(config.OUTPUT_DIR, final_file_name)
-        
-        img.save(output_path)
+def translated_file_name(orig_name, orig_ext):
+    return f'{orig_name}_translated.{orig_ext}'
 
-        translated_file_names.append(final_file_name)
-    return translated_file_names
 
 def create_zip(processed_images, original_filename, original_file_extensions):
 
@@ -1,14 +1,18 @@
 # This is where all the necessary variable will be placed, such as env variables
 import os
-import torch
 SERVER_URL = 'http://127.0.0.1:8000'
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(APP_ROOT)
 INPUT_DIR = os.path.join(PROJECT_ROOT, 'input')
 OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'output')
 FONT_PATH = os.path.join(APP_ROOT, 'assets', 'fonts', 'DejaVuSans.ttf')
+CACHE_DIR = os.path.join(PROJECT_ROOT, 'cache')
+
+# Bump this whenever a change makes the pipeline output different, it invalidates everything that was cached with the old version
+CONFIG_VERSION = '2'
 
 DETECTOR_MODEL_ID = "ogkalu/comic-text-and-bubble-detector"
+OCR_MODEL_ID = "kha-white/manga-ocr-base"
 INPAINTER_MODEL = "https://github.com/Sanster/models/releases/download/AnimeMangaInpainting/anime-manga-big-lama.pt"
 CACHED_MODEL_DIR = os.path.join(PROJECT_ROOT, 'cached_models')
 CACHED_INPAINTER_MODEL = "anime-manga-big-lama.pt"
@@ -17,11 +21,125 @@ CACHED_INPAINTER_MODEL_PATH = os.path.join(CACHED_MODEL_DIR, CACHED_INPAINTER_MO
 print(f'{CACHED_INPAINTER_MODEL_PATH}')
 
 
-if torch.cuda.is_available():
-    DEVICE = 'cuda'
-    print(f'running in cuda, cuda: {torch.cuda.is_available()}')
-else:
-    DEVICE = 'cpu'
-    print(f'running in cpu, cuda: {torch.cuda.is_available()}')
+# DEVICE is only probed the first time it's read (by the model loader threads), importing torch takes seconds and the server shouldn't wait for it to start
+def __getattr__(name):
+    global DEVICE
+    if name != 'DEVICE':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    import torch
+    if torch.cuda.is_available():
+        DEVICE = 'cuda'
+        print(f'running in cuda, cuda: {torch.cuda.is_available()}')
+    else:
+        DEVICE = 'cpu'
+        print(f'running in cpu, cuda: {torch.cuda.is_available()}')
+    return DEVICE
 DETECTION_CONFIDENCE = 0.80
-IOU_THRESHOLD = 0.3
\ No newline at end of file
+DETECTION_RESIZE_REDUCING_GAP = None # None resizes pages for the detector exactly like its processor does, a value like 3.0 lets Pillow shrink big scans with a fast box reduce first (slightly different detections)
+IOU_THRESHOLD = 0.3
+OCR_BATCH_SIZE = 16 # How many bubble crops go through MangaOcr in a single forward pass
+
+# Inpainting
+INPAINT_MODE = 'region' # 'region' only sends padded tiles around the text boxes to LaMa, 'full' sends the whole page
+INPAINT_STRIDE = 8 # LaMa needs both dimensions to be divisible by 8
+INPAINT_REGION_MARGIN = 64 # Context (in pixels) kept around each text box so the model can see the surrounding bubble
+INPAINT_REGION_MERGE_DISTANCE = 32 # Tiles closer than this get merged together
+INPAINT_MAX_TILE_SIZE = 1024 # Tiles are never merged past this width/height, which keeps peak memory bounded. Only a single text box bigger than this gets a bigger tile
+INPAINT_TILE_BUCKET = 64 # Tiles are grown (with real page content) to a multiple of this so more of them share a size and get batched, must be a multiple of INPAINT_STRIDE
+INPAINT_BATCH_MAX_PIXELS = 4 * 1024 ** 2 # Pixels per LaMa forward pass when batching pages or tiles of the same size
+INPAINT_BUFFER_CACHE_BYTES = 64 * 1024 ** 2 # Input/output tensors kept allocated per model thread for the shapes that come back (tiles), bigger ones (full pages) are freed after each call, 0 allocates them on every call
+
+# Text rendering
+FONT_CACHE_SIZE = 64 # Loaded (font path, size) pairs kept in memory
+TEXT_MEASURE_CACHE_SIZE = 8192 # Measured lines kept in memory
+TEXT_LAYOUT_CACHE_SIZE = 1024 # Wrapped text and font size of the last rendered bubbles
+
+# Model worker processes, for CPU-only boxes where a single process leaves cores idle
+MODEL_WORKER_PROCESSES = 0 # Processes that each load the detector, OCR and inpainter once, 0 keeps the models in the server process
+MODEL_WORKER_THREADS = None # Torch threads per worker process, None splits the cores evenly between the workers
+
+# Model loading, done in background threads so the server answers (and queues pages) while the models load
+MODEL_LOADER_THREADS = 2 # Models loaded at the same time, the others wait for a free thread in MODEL_LOAD_ORDER. Warm-ups run on threads of their own and never hold up the next model
+MODEL_LOAD_ORDER = ['detector', 'inpainter', 'ocr'] # Cheapest first, so the first stages of the pipeline can start early. Only matters with fewer MODEL_LOADER_THREADS than models
+MODEL_WARMUP = True # Run every model once on a dummy input after loading it, so the first request doesn't pay the first call costs
+MODEL_WARMUP_PAGE_SIZE = (1024, 1448) # Dummy page the detector is warmed up on
+MODEL_WARMUP_TILE_SIZE = 512 # Dummy tile the inpainter is warmed up on, must be a multiple of INPAINT_STRIDE
+
+# Inference backend of each model, benchmarks/compare_backends.py measures their speed and how close their output is to eager
+# 'eager' plain PyTorch, 'int8' dynamic int8 quantization of the Linear layers, 'compiled' torch.compile (a frozen TorchScript for LaMa) with channels-last inputs,
+# 'onnx' exported once and run with onnxruntime (pip install onnxruntime). int8 and onnx are CPU only, on a GPU the models stay eager
+INFERENCE_BACKENDS = {'detector': 'eager', 'ocr': 'eager', 'inpainter': 'eager'} # Supported: detector eager/int8/compiled/onnx, ocr eager/int8/compiled, inpainter eager/compiled
+OPTIMIZED_MODEL_DIR = os.path.join(CACHED_MODEL_DIR, 'optimized') # Exported/frozen models, rebuilt when the torch version changes
+ONNX_OPSET = 17
+
+# Detection micro-batching, pages of concurrent requests are detected together
+DETECTION_BATCHING_ENABLED = True
+DETECTION_BATCH_WINDOW = 0.01 # Seconds the first page of a batch waits for pages of other requests, only while several requests are detecting (JOB_WORKERS > 1)
+DETECTION_MAX_BATCH_SIZE = 8 # Pages per forward pass
+DETECTION_MAX_BATCH_PIXELS = 64 * 1024 ** 2 # Decoded pixels per forward pass, bounds the memory the processor needs for a batch
+
+# Uploads are spooled to disk and only decoded when the pipeline gets to them
+UPLOAD_SPOOL_DIR = None # None uses the system temp directory
+UPLOAD_READ_CHUNK_SIZE = 1024 ** 2
+UPLOAD_DRAFT_DETECTION = True # Detect JPEG uploads on a reduced decode (1/2, 1/4 or 1/8 scale) instead of the full page
+UPLOAD_DRAFT_SIZE = (640, 640) # The reduced decode is never smaller than this, matches the detector input size
+
+# Output encoding, done in a thread pool off the event loop
+OUTPUT_WRITER_THREADS = 2
+OUTPUT_DELIVERY_FORMATS = ['png', 'jpeg', 'webp', 'avif'] # What clients can ask for with output_format, 'original' (the default) keeps the format of the upload
+OUTPUT_FORMAT_OPTIONS = { # Pillow save options of each format
+    'PNG': {'compress_level': 3}, # Much faster than the default 6 for a slightly bigger file
+    'JPEG': {'quality': 90, 'optimize': True},
+    'WEBP': {'quality': 85, 'method': 4},
+    'AVIF': {'quality': 70, 'speed': 6},
+}
+
+# 'production' only does the work needed to produce the result, 'debug' also saves debug images of every page and prints verbose logs
+APP_MODE = os.getenv('APP_MODE', 'production')
+DEBUG_SAMPLE_RATE = 0 # In production, still save the debug images of 1 in N requests (0 never)
+DEBUG_OUTPUT_DIR = os.path.join(OUTPUT_DIR, 'debug') # One folder per debugged request
+
+# Observability, stage latencies are always exported on /metrics
+SERVER_TIMING_ENABLED = True # Adds a Server-Timing header with the time of each stage to the translation responses
+
+# Jobs
+JOB_BACKEND = 'local' # Only the in process queue exists for now
+JOB_QUEUE_MAX_SIZE = 16 # Batches waiting for a worker, new submissions get a 429 past this
+JOB_WORKERS = 1 # Batches processed at the same time, each one gets a model thread and an inpainting thread of its own. Detection only batches pages of different requests with more than 1
+JOB_MAX_FINISHED_JOBS = 256 # Finished jobs kept around for the status/result endpoints
+
+# Result cache of fully translated pages
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_DIR = os.path.join(OUTPUT_DIR, 'cache') # Served under /translated/cache/
+RESULT_CACHE_INDEX_PATH = os.path.join(CACHE_DIR, 'result_cache.sqlite3')
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3 # Least recently used pages are evicted past this
+
+# Detections and OCR text of every page, so switching translator or re-rendering a page skips the vision models
+STAGE_CACHE_ENABLED = True
+STAGE_CACHE_PATH = os.path.join(CACHE_DIR, 'stage_cache.sqlite3')
+STAGE_CACHE_MAX_ENTRIES = 100000
+STAGE_CACHE_PRUNE_INTERVAL = 100 # Puts between two checks of the max entries
+
+# Translation memory, every line translated by a provider is kept so only new lines go out to the API
+TRANSLATION_MEMORY_ENABLED = True
+TRANSLATION_MEMORY_PATH = os.path.join(CACHE_DIR, 'translation_memory.sqlite3')
+
+# Translation requests
+TRANSLATION_CHUNK_MAX_LINES = 40 # Lines sent to the provider in a single request
+TRANSLATION_CHUNK_MAX_CHARS = 2000 # Characters sent to the provider in a single request
+TRANSLATION_MAX_CONCURRENCY = 4 # Requests in flight at the same time for a provider missing from PROVIDER_MAX_CONNECTIONS
+TRANSLATION_CHUNK_RETRIES = 2 # Retries of a failed chunk before it gets split in half
+TRANSLATION_RETRY_BACKOFF = 1.0 # Seconds before the first retry, doubled on every retry
+
+# Translation provider clients, all async with pooled keep-alive connections
+PROVIDER_MAX_CONNECTIONS = {'gemini': 4, 'deepseek': 8, 'google': 4} # Also the number of requests in flight per provider
+PROVIDER_TIMEOUTS = {'gemini': 60.0, 'deepseek': 60.0, 'google': 15.0} # Seconds
+PROVIDER_DEFAULT_TIMEOUT = 60.0
+PROVIDER_KEEPALIVE_EXPIRY = 30.0 # Seconds an idle connection is kept open
+
+# Page scheduler, every page of a request flows through the detect, OCR, translate and inpaint+render stages
+PIPELINE_QUEUE_SIZE = 4 # Pages waiting between two stages, bounds how far a stage can run ahead of the next one
+PIPELINE_DETECT_BATCH_PAGES = 2 # Pages detected together
+PIPELINE_OCR_BATCH_PAGES = 4 # Max ready pages OCR'd together
+PIPELINE_TRANSLATION_BATCH_PAGES = 8 # Max ready pages translated in a single translate_batch call
@@ -0,0 +1,163 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from app import config
+from app.utils import metrics
+
+
+class DetectionRequest:
+    def __init__(self, image):
+        self.image = image
+        self.pixels = image.size[0] * image.size[1]
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+# Micro-batching front for the detector, has the same detect(image_list) interface as BubbleDetector
+# Pages from concurrent callers are collected for a short window and go through the model in a single forward pass
+# detect blocks until its pages are done, submit returns their futures so the page scheduler can await them on the event loop
+# The window is only waited when more than one caller is registered, there is nobody to batch with otherwise
+# Requests only run side by side with JOB_WORKERS > 1, with a single job worker the batches are the pages of one request
+class DetectionBatcher:
+    def __init__(self, detector, window=None, max_batch_size=None, max_batch_pixels=None):
+        self.detector = detector
+        self.window = window if window is not None else config.DETECTION_BATCH_WINDOW
+        self.max_batch_size = max_batch_size or config.DETECTION_MAX_BATCH_SIZE
+        self.max_batch_pixels = max_batch_pixels or config.DETECTION_MAX_BATCH_PIXELS
+
+        self.requests = queue.Queue()
+        self.active_callers = 0
+        # A page that did not fit in the previous batch, it starts the next one
+        self.held_request = None
+
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.pages = 0
+        self.batch_sizes = {}
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+        self.thread = threading.Thread(target=self.run, name='detection-batcher', daemon=True)
+        self.thread.start()
+
+    def detect(self, image_list):
+        return [future.result() for future in self.submit(image_list)]
+
+    # Queues the pages and returns a concurrent future per page
+    def submit(self, image_list):
+        requests = [DetectionRequest(image) for image in image_list]
+        for request in requests:
+            self.requests.put(request)
+
+        return [request.future for request in requests]
+
+    # Held by every request that is sending pages, while there are several of them it's worth waiting for the others
+    @contextmanager
+    def caller(self):
+        with self.stats_lock:
+            self.active_callers += 1
+        try:
+            yield
+        finally:
+            with self.stats_lock:
+                self.active_callers -= 1
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            if batch is None:
+                return
+            # A bad batch must not end the thread, every later detection would wait forever
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                print(f"[DetectionBatcher] Batch of {len(batch)} pages failed: {e}", flush=True)
+
+    # Wait for a first page, then take whatever else comes in during the window until the batch is full
+    # Returns None once the batcher is closed
+    def collect_batch(self):
+        first = self.held_request
+        self.held_request = None
+        if first is None:
+            first = self.requests.get()
+            if first is None:
+                return None
+
+        batch = [first]
+        batch_pixels = first.pixels
+        # A lone caller already sent every page it has for now, only take what is queued
+        window = self.window if self.active_callers > 1 else 0.0
+        deadline = time.perf_counter() + window
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+
+            if request is None:
+                # Finish what we have, the next get sees the closed queue
+                self.requests.put(None)
+                break
+
+            if batch_pixels + request.pixels > self.max_batch_pixels:
+                self.held_request = request
+                break
+
+            batch.append(request)
+            batch_pixels += request.pixels
+
+        return batch
+
+    def run_batch(self, batch):
+        # The futures of a cancelled job are cancelled by asyncio, those pages are dropped. The others can't be cancelled anymore
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        started_at = time.perf_counter()
+        self.record(batch, started_at)
+
+        try:
+            results = self.detector.detect([request.image for request in batch])
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+    def record(self, batch, started_at):
+        metrics.DETECTION_BATCH_SIZE.observe(len(batch))
+        for request in batch:
+            metrics.DETECTION_QUEUE_WAIT_SECONDS.observe(started_at - request.queued_at)
+
+        with self.stats_lock:
+            self.batches += 1
+            self.pages += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+            for request in batch:
+                queue_wait = started_at - request.queued_at
+                self.total_queue_wait += queue_wait
+                self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'batches': self.batches,
+                'pages': self.pages,
+                'averageBatchSize': self.pages / self.batches if self.batches else 0.0,
+                'batchSizes': dict(sorted(self.batch_sizes.items())),
+                'averageQueueWait': self.total_queue_wait / self.pages if self.pages else 0.0,
+                'maxQueueWait': self.max_queue_wait,
+                'queued': self.requests.qsize(),
+            }
@@ -0,0 +1,166 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app import config
+from app.utils import metrics
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, payload):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.status = 'queued' # queued -> running -> done | failed
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = asyncio.Event()
+        self.timings = metrics.StageTimings()
+
+    def to_dict(self):
+        return {
+            'jobId': self.id,
+            'status': self.status,
+            'error': self.error,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at,
+        }
+
+
+# Interface of a job backend, the app only talks to this so the local queue can be swapped for a distributed one
+class JobBackend:
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    # Queue the payload and return the Job right away, raises JobQueueFullError when no more jobs can be accepted
+    def submit(self, payload):
+        raise NotImplementedError
+
+    def get(self, job_id):
+        raise NotImplementedError
+
+    async def wait(self, job_id):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+# In process job queue: a bounded asyncio queue drained by a fixed number of workers
+# Each worker runs one job at a time and its blocking model work goes to a thread pool of the same size
+class LocalJobQueue(JobBackend):
+    def __init__(self, handler, discard=None, max_queue_size=None, num_workers=None, max_finished_jobs=None):
+        # handler(payload, executor) is the coroutine that actually processes a job and returns its result
+        self.handler = handler
+        # discard(payload) cleans up the payload of a job that will never run (its spooled uploads)
+        self.discard = discard
+        self.max_queue_size = max_queue_size or config.JOB_QUEUE_MAX_SIZE
+        self.num_workers = num_workers or config.JOB_WORKERS
+        self.max_finished_jobs = max_finished_jobs or config.JOB_MAX_FINISHED_JOBS
+
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        # With model worker processes the threads mostly wait on the processes, give each job enough of them to keep every process busy
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers * max(1, config.MODEL_WORKER_PROCESSES), thread_name_prefix='model-worker')
+        self.jobs = OrderedDict()
+        self.workers = []
+
+        metrics.QUEUE_DEPTH.labels('jobs').set_function(self.queue.qsize)
+
+    async def start(self):
+        self.workers = [asyncio.create_task(self.worker(i)) for i in range(self.num_workers)]
+        print(f"[Jobs] Started {self.num_workers} worker(s), queue size {self.max_queue_size}", flush=True)
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        # Jobs that never started: their payload is cleaned up and whoever waits on them gets the failure right away
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            job.status = 'failed'
+            job.error = 'Server is shutting down'
+            if self.discard is not None and job.payload is not None:
+                self.discard(job.payload)
+            job.payload = None
+            job.finished_at = time.time()
+            job.finished.set()
+            self.queue.task_done()
+
+    def submit(self, payload):
+        job = Job(payload)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"Job queue is full ({self.max_queue_size} jobs waiting)")
+
+        self.jobs[job.id] = job
+        self.forget_old_jobs()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def wait(self, job_id):
+        job = self.jobs[job_id]
+        await job.finished.wait()
+        return job
+
+    def stats(self):
+        running = sum(1 for job in self.jobs.values() if job.status == 'running')
+        return {
+            'queued': self.queue.qsize(),
+            'running': running,
+            'maxQueueSize': self.max_queue_size,
+            'workers': self.num_workers,
+        }
+
+    async def worker(self, worker_index):
+        while True:
+            job = await self.queue.get()
+            job.status = 'running'
+            job.started_at = time.time()
+            try:
+                with metrics.collect_timings(job.timings):
+                    job.result = await self.handler(job.payload, self.executor)
+                job.status = 'done'
+            except asyncio.CancelledError:
+                job.status = 'failed'
+                job.error = 'Server is shutting down'
+                raise
+            except Exception as e:
+                print(f"[Jobs] Job {job.id} failed on worker {worker_index}: {e}", flush=True)
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                # No need to keep the payload around once the job is over
+                job.payload = None
+                job.finished_at = time.time()
+                job.finished.set()
+                self.queue.task_done()
+
+    # Only keep the most recent finished jobs so their results don't pile up in memory
+    def forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished.is_set()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+
+def create_job_backend(handler, discard=None):
+    if config.JOB_BACKEND == 'local':
+        return LocalJobQueue(handler, discard)
+
+    raise ValueError(f"Unknown job backend: {config.JOB_BACKEND}")
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+from app import config
+from app.utils import metrics
+
+
+# The processing modules import torch/transformers, they are only imported from the loader threads so the server starts right away
+def load_detector():
+    from app.processing.bubble_detection import BubbleDetector
+    detector = BubbleDetector()
+    # With onnx the weights live in onnxruntime, the exported file is about their size
+    if detector.onnx_session is not None:
+        metrics.MODEL_MEMORY.labels('detector').set(os.path.getsize(detector.onnx_path))
+    else:
+        metrics.MODEL_MEMORY.labels('detector').set(metrics.model_size_bytes(detector.model))
+    return detector
+
+
+def load_ocr():
+    from app.processing.ocr import OcrProcessor
+    ocr = OcrProcessor()
+    metrics.MODEL_MEMORY.labels('ocr').set(metrics.model_size_bytes(ocr.mocr.model))
+    return ocr
+
+
+def load_inpainter():
+    from app.processing.inpainting import InPainter
+    inpainter = InPainter()
+    metrics.MODEL_MEMORY.labels('inpainter').set(metrics.model_size_bytes(inpainter.model))
+    return inpainter
+
+
+# Warm-ups run each model once on a blank input, the first call of a model is much slower (lazy init, allocator, oneDNN kernels)
+def warm_up_detector(detector):
+    detector.detect([Image.new('RGB', config.MODEL_WARMUP_PAGE_SIZE, 'white')])
+
+
+def warm_up_ocr(ocr):
+    ocr.extract_text_batch([Image.new('RGB', (64, 64), 'white')])
+
+
+def warm_up_inpainter(inpainter):
+    size = (config.MODEL_WARMUP_TILE_SIZE, config.MODEL_WARMUP_TILE_SIZE)
+    inpainter.inpaint(Image.new('RGB', size, 'white'), Image.new('L', size, 255))
+
+
+MODEL_LOADERS = {
+    'detector': (load_detector, warm_up_detector),
+    'ocr': (load_ocr, warm_up_ocr),
+    'inpainter': (load_inpainter, warm_up_inpainter),
+}
+
+
+# Stands in for a model that is still loading, any attribute access waits for the model and is forwarded to it
+# The pipeline only uses the models from its executor threads, so the waiting never blocks the event loop
+class LazyModel:
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(self.loader.get(self.name), attribute)
+
+
+# Loads the models in background threads, in the order they are submitted, and keeps track of their state for /ready
+# A model goes through pending -> loading -> warming -> ready, or failed. It can already be used while warming
+# Warm-ups run in their own threads, a loader thread moves on to the next model as soon as its model is loaded
+class ModelLoader:
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or config.MODEL_LOADER_THREADS, thread_name_prefix='model-loader')
+        self.warm_up_executor = ThreadPoolExecutor(max_workers=max_workers or config.MODEL_LOADER_THREADS, thread_name_prefix='model-warm-up')
+        self.lock = threading.Lock()
+        self.models = {}
+
+    # Starts loading a model, returns a LazyModel to use in its place
+    def load(self, name, load_fn, warm_up_fn=None):
+        with self.lock:
+            self.models[name] = {'state': 'pending', 'future': Future(), 'done': threading.Event(), 'seconds': None, 'error': None}
+        self.executor.submit(self.run, name, load_fn, warm_up_fn)
+        return LazyModel(self, name)
+
+    def run(self, name, load_fn, warm_up_fn):
+        model_state = self.models[name]
+        future = model_state['future']
+        start = time.perf_counter()
+
+        self.set_state(name, 'loading')
+        print(f"[ModelLoader] Loading {name}", flush=True)
+        try:
+            model = load_fn()
+        except Exception as e:
+            print(f"[ModelLoader] Loading {name} failed: {e}", flush=True)
+            with self.lock:
+                model_state['state'] = 'failed'
+                model_state['error'] = str(e)
+            future.set_exception(e)
+            model_state['done'].set()
+            return
+
+        future.set_result(model)
+
+        if warm_up_fn is None:
+            self.set_ready(name, start)
+            return
+
+        self.set_state(name, 'warming')
+        try:
+            self.warm_up_executor.submit(self.warm_up, name, model, warm_up_fn, start)
+        except RuntimeError:
+            # The loader was closed while this model was loading, nobody is going to use it
+            self.set_ready(name, start)
+
+    def warm_up(self, name, model, warm_up_fn, start):
+        try:
+            warm_up_fn(model)
+        except Exception as e:
+            # The model itself loaded fine, the first real request just pays the warm-up
+            print(f"[ModelLoader] Warming up {name} failed: {e}", flush=True)
+        self.set_ready(name, start)
+
+    # start is when the model started loading, the load time includes the warm-up
+    def set_ready(self, name, start):
+        model_state = self.models[name]
+        seconds = time.perf_counter() - start
+        with self.lock:
+            model_state['state'] = 'ready'
+            model_state['seconds'] = seconds
+        model_state['done'].set()
+        metrics.MODEL_LOAD_SECONDS.labels(name).set(seconds)
+        print(f"[ModelLoader] {name} ready in {seconds:.1f}s", flush=True)
+
+    def set_state(self, name, state):
+        with self.lock:
+            self.models[name]['state'] = state
+
+    # Blocks until the model is loaded, raises the loading error if it failed
+    def get(self, name, timeout=None):
+        return self.models[name]['future'].result(timeout)
+
+    # Blocks until every model is ready or failed, warm-ups included
+    def wait_all(self):
+        for model_state in list(self.models.values()):
+            model_state['done'].wait()
+
+    def is_ready(self):
+        with self.lock:
+            return all(model_state['state'] == 'ready' for model_state in self.models.values())
+
+    def failed_models(self):
+        with self.lock:
+            return [name for name, model_state in self.models.items() if model_state['state'] == 'failed']
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: {'state': model_state['state'], 'seconds': model_state['seconds'], 'error': model_state['error']}
+                for name, model_state in self.models.items()
+            }
+
+    def close(self):
+        # A model still loading can't be interrupted, but the ones that did not start yet never will
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.warm_up_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,184 @@
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app import config
+
+
+# Models of the current worker process, loaded once by init_worker
+worker_models = {}
+
+
+# Runs once in every worker process, before it picks up any work
+def init_worker(num_threads, ready_barrier):
+    worker_models['ready_barrier'] = ready_barrier
+
+    import torch
+
+    # Each process only gets its share of the cores, otherwise every worker spawns one intra-op thread per core and they fight over them
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    from app.processing.bubble_detection import BubbleDetector
+    from app.processing.ocr import OcrProcessor
+    from app.processing.inpainting import InPainter
+
+    worker_models['detector'] = BubbleDetector()
+    worker_models['ocr'] = OcrProcessor()
+    worker_models['inpainter'] = InPainter()
+
+    print(f"[ModelWorker {os.getpid()}] Models loaded, {num_threads} thread(s)", flush=True)
+
+
+# Holds its worker until every worker got one, so N of them can only be run by N different (loaded) workers
+def worker_ready():
+    worker_models['ready_barrier'].wait()
+    return os.getpid()
+
+
+def run_detection(image_list):
+    results = worker_models['detector'].detect(image_list)
+
+    # Plain arrays are cheaper to send back to the main process than tensors
+    return [{key: value.detach().cpu().numpy() for key, value in result.items()} for result in results]
+
+
+def run_ocr(crops, batch_size):
+    return worker_models['ocr'].extract_text_batch(crops, batch_size=batch_size)
+
+
+def run_inpainting(image, mask):
+    return worker_models['inpainter'].inpaint(image, mask)
+
+
+def run_inpainting_batch(pairs):
+    images, masks = zip(*pairs)
+    return worker_models['inpainter'].inpaint_batch(list(images), list(masks))
+
+
+# Splits items into at most num_chunks consecutive chunks of at least min_size items
+def split_in_chunks(items, num_chunks, min_size=1):
+    chunk_size = max(min_size, math.ceil(len(items) / num_chunks))
+    return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+
+# Pool of processes that each load BubbleDetector, OcrProcessor and InPainter once
+# The detector/ocr/inpainter attributes have the same interface as the models so the pipeline can use them as is
+# Calls block until the workers are done, so they are meant to be made from the model executor threads like the models themselves
+class ModelWorkerPool:
+    def __init__(self, num_processes=None, threads_per_process=None):
+        self.num_processes = num_processes or config.MODEL_WORKER_PROCESSES
+        self.threads_per_process = threads_per_process or config.MODEL_WORKER_THREADS or max(1, (os.cpu_count() or 1) // self.num_processes)
+
+        self.lock = threading.Lock()
+        self.executor = self.make_executor()
+
+        self.detector = RemoteDetector(self)
+        self.ocr = RemoteOcr(self)
+        self.inpainter = RemoteInPainter(self)
+
+    def make_executor(self):
+        # Spawn instead of fork, forking a process that already imported torch can deadlock its thread pools
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(
+            max_workers=self.num_processes,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(self.threads_per_process, context.Barrier(self.num_processes)),
+        )
+
+    # Starts every worker and waits until they all loaded their models
+    def start(self):
+        # A new process is only spawned when no worker is idle, so submitting them all at once starts all of them
+        # and the barrier in worker_ready makes sure no worker returns before all of them loaded their models
+        futures = [self.executor.submit(worker_ready) for _ in range(self.num_processes)]
+        pids = {future.result() for future in futures}
+        print(f"[ModelWorkerPool] {len(pids)} worker process(es) ready, {self.threads_per_process} thread(s) each", flush=True)
+
+    # Submits to the current executor, a pool broken by a dead worker (OOM, segfault) is replaced before the error goes up
+    # The call that hit the broken pool still fails, the next ones go to the new workers
+    def submit(self, fn, *args):
+        executor = self.executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.restart(executor)
+            raise
+
+    def result(self, future, executor):
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.restart(executor)
+            raise
+
+    # Only the first thread to notice a broken executor replaces it
+    def restart(self, broken_executor):
+        with self.lock:
+            if self.executor is not broken_executor:
+                return
+            print("[ModelWorkerPool] A worker process died, restarting the pool", flush=True)
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.make_executor()
+            self.start()
+
+    # Runs fn on every chunk in the workers, results come back in the same order as the chunks
+    def map_in_order(self, fn, chunks, *args):
+        executor = self.executor
+        futures = [self.submit(fn, chunk, *args) for chunk in chunks]
+        return [self.result(future, executor) for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class RemoteDetector:
+    def __init__(self, pool):
+        self.pool = pool
+
+    # Pages are spread across the workers and the results put back in page order
+    def detect(self, image_list):
+        chunks = split_in_chunks(image_list, self.pool.num_processes)
+        results = self.pool.map_in_order(run_detection, chunks)
+        return [result for chunk_results in results for result in chunk_results]
+
+
+class RemoteOcr:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def extract_text_batch(self, crops, batch_size=None):
+        if not crops:
+            return []
+
+        batch_size = batch_size or config.OCR_BATCH_SIZE
+
+        # Never split below a full batch, a worker gets whole batches so it still benefits from batched generation
+        chunks = split_in_chunks(crops, self.pool.num_processes, min_size=batch_size)
+        results = self.pool.map_in_order(run_ocr, chunks, batch_size)
+        return [text for chunk_texts in results for text in chunk_texts]
+
+
+class RemoteInPainter:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def inpaint(self, image, mask):
+        executor = self.pool.executor
+        return self.pool.result(self.pool.submit(run_inpainting, image, mask), executor)
+
+    # Inputs are sorted by size before being spread across the workers so each worker still gets same sized inputs to batch
+    def inpaint_batch(self, images, masks):
+        if not images:
+            return []
+
+        order = sorted(range(len(images)), key=lambda index: images[index].size)
+        chunks = split_in_chunks([(images[index], masks[index]) for index in order], self.pool.num_processes)
+        outputs = [output for chunk_outputs in self.pool.map_in_order(run_inpainting_batch, chunks) for output in chunk_outputs]
+
+        results = [None] * len(images)
+        for index, output in zip(order, outputs):
+            results[index] = output
+        return results
@@ -0,0 +1,91 @@
+import asyncio
+import contextvars
+import functools
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from PIL import Image, features
+from app import config
+from app.utils import metrics
+
+
+# Pillow format of an extension like 'jpg' or 'webp', None when Pillow can't write it
+def format_for_extension(extension):
+    image_format = Image.registered_extensions().get(f'.{extension.lower()}')
+    if image_format is None or image_format not in Image.SAVE:
+        return None
+    return image_format
+
+
+# Formats the clients can ask for, AVIF depends on how Pillow was built
+def available_output_formats():
+    formats = []
+    for extension in config.OUTPUT_DELIVERY_FORMATS:
+        if extension == 'avif' and not features.check('avif'):
+            continue
+        if format_for_extension(extension):
+            formats.append(extension)
+    return formats
+
+
+# Yields a temporary path next to path, which replaces path once the block succeeds
+@contextmanager
+def atomic_path(path):
+    directory, file_name = os.path.split(path)
+    tmp_path = os.path.join(directory, f'.{file_name}.{uuid.uuid4().hex}.tmp')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+# Encodes the translated pages in a thread pool so big PNGs don't block the event loop
+# Every file is written to a temporary name first and renamed, so nobody ever gets served a half written page
+class OutputWriter:
+    def __init__(self, output_dir=None, max_workers=None):
+        self.output_dir = output_dir or config.OUTPUT_DIR
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or config.OUTPUT_WRITER_THREADS, thread_name_prefix='output-writer')
+
+    def save_options(self, image_format):
+        return dict(config.OUTPUT_FORMAT_OPTIONS.get(image_format, {}))
+
+    # Blocking, returns the path of the written file
+    def write(self, image, file_name):
+        image_format = format_for_extension(os.path.splitext(file_name)[1].lstrip('.'))
+        if image_format is None:
+            raise ValueError(f"Can't write {file_name}, unknown image format")
+
+        path = os.path.join(self.output_dir, file_name)
+        with metrics.timed('save'), atomic_path(path) as tmp_path:
+            image.save(tmp_path, format=image_format, **self.save_options(image_format))
+        return path
+
+    # Blocking, copies an already encoded file (a cached page) to its output name
+    def copy(self, source_path, file_name):
+        path = os.path.join(self.output_dir, file_name)
+        with atomic_path(path) as tmp_path:
+            shutil.copyfile(source_path, tmp_path)
+        return path
+
+    async def save(self, image, file_name):
+        return await self.run(self.write, image, file_name)
+
+    async def save_copy(self, source_path, file_name):
+        return await self.run(self.copy, source_path, file_name)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        # Carries the stage timings of the request over to the writer thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
@@ -1,28 +1,82 @@
 from PIL import Image, ImageDraw, ImageFilter
 from app import config
 import os, glob, math
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 import cv2
 import numpy as np
 
-from app.processing.bubble_detection import BubbleDetector
-from app.processing.ocr import OcrProcessor
-from app.processing.inpainting import InPainter
 from app.processing.translation import TextTranslator
-from app.utils.box_calculations import group_by_iou, shrink_box, enlarge_box
+from app.utils.box_calculations import group_detections_batch, shrink_box, enlarge_box, merge_into_regions, box_inside, to_numpy
 from app.utils.render_box import draw_text_in_box
+from app.core.stage_cache import StageCache, hash_image
+from app.core.model_workers import ModelWorkerPool
+from app.core.model_loader import ModelLoader, MODEL_LOADERS
+from app.core.detection_batcher import DetectionBatcher
+from app.core.uploads import SpooledPage
+from app.core.output_writer import OutputWriter
+from app.utils import metrics, debug
 
 print("[Pipeline Imports] All imports successful.")
 
 
 
 class MangaTranslationPipeline:
-    def __init__(self, translator_option='google'):
-
-        self.detector = BubbleDetector()
-        self.ocr = OcrProcessor()
-        self.translator = TextTranslator()
-        self.inpainter = InPainter()
+    # The models and the translator can be passed in (the benchmarks use stubs), only the missing ones are loaded
+    # Models load in the background, pages wait in the stage that needs a model until that model is there
+    def __init__(self, translator_option='google', detector=None, ocr=None, inpainter=None, translator=None):
+        self.model_loader = ModelLoader()
+
+        # With worker processes the models only live in the workers, the pipeline talks to them through the pool
+        self.model_pool = None
+        if config.MODEL_WORKER_PROCESSES > 0 and detector is None and ocr is None and inpainter is None:
+            self.model_pool = ModelWorkerPool()
+            # Calls made before the workers are up simply wait for them in the pool queue
+            self.model_loader.load('model_workers', self.model_pool.start)
+            self.detector = self.model_pool.detector
+            self.ocr = self.model_pool.ocr
+            self.inpainter = self.model_pool.inpainter
+        else:
+            models = {'detector': detector, 'ocr': ocr, 'inpainter': inpainter}
+            for name in config.MODEL_LOAD_ORDER:
+                if models[name] is None:
+                    load_fn, warm_up_fn = MODEL_LOADERS[name]
+                    models[name] = self.model_loader.load(name, load_fn, warm_up_fn if config.MODEL_WARMUP else None)
+
+            self.detector = models['detector']
+            self.ocr = models['ocr']
+            self.inpainter = models['inpainter']
+
+        # Pages of concurrent requests share detector forward passes
+        self.detection_batcher = None
+        if config.DETECTION_BATCHING_ENABLED:
+            self.detection_batcher = DetectionBatcher(self.detector)
+            self.detector = self.detection_batcher
+            metrics.QUEUE_DEPTH.labels('detection').set_function(self.detection_batcher.requests.qsize)
+
+        self.translator = translator if translator is not None else TextTranslator()
+        self.output_writer = OutputWriter()
+        # LaMa gets threads of its own, on the job executor it would run before the OCR of its page instead of alongside it
+        self.inpaint_executor = ThreadPoolExecutor(max_workers=config.JOB_WORKERS, thread_name_prefix='inpainter')
         self.bubble_map = {0: "bubble", 1: "text_bubble", 2: "text_free"}
+
+        # Detections and OCR text of the pages we already saw, only reused with the same models and settings
+        self.stage_cache = StageCache() if config.STAGE_CACHE_ENABLED else None
+        self.detection_model_id = f"{config.DETECTOR_MODEL_ID}:{config.INFERENCE_BACKENDS.get('detector')}:{config.DETECTION_CONFIDENCE}:{config.IOU_THRESHOLD}:{config.DETECTION_RESIZE_REDUCING_GAP}:{config.UPLOAD_DRAFT_DETECTION}"
+        self.ocr_model_id = f"{config.OCR_MODEL_ID}:{config.INFERENCE_BACKENDS.get('ocr')}:{self.detection_model_id}"
+    
+    def close(self):
+        self.model_loader.close()
+        self.output_writer.close()
+        self.inpaint_executor.shutdown(wait=False, cancel_futures=True)
+        if self.detection_batcher is not None:
+            self.detection_batcher.close()
+        if self.model_pool is not None:
+            self.model_pool.close()
     
     # This runs detection and OCR
     def detect_and_extract_text(self, image_list):
@@ -30,28 +84,175 @@ class MangaTranslationPipeline:
         Runs the CPU-bound detection and OCR steps.
         This is a synchronous, blocking function.
         """
-        # Detect all the text bubbles and corresponding coordinates from the images
-        all_raw_results = self.detector.detect(image_list)
+        image_hashes = self.hash_images(image_list)
+
+        all_bubble_data = self.detect_pages(image_list, image_hashes)
+        self.ocr_pages(all_bubble_data, image_list, image_hashes)
+
+        return dict(enumerate(all_bubble_data))
+
+
+    # Hashes used as stage cache keys, None when the stage cache is off
+    def hash_images(self, image_list):
+        if self.stage_cache is None:
+            return None
+        return [hash_image(image) for image in image_list]
+
+
+    # Detect and group the bubbles of every page, returns a list with the bubbles of each page (without their text yet)
+    # Pages that were already detected with the same model and settings come from the stage cache
+    # page_sizes are the full sizes of the pages when image_list holds reduced versions of them, the boxes are scaled back to those
+    def detect_pages(self, image_list, image_hashes=None, page_sizes=None):
+        all_bubble_data, missing_detections = self.cached_detections(image_hashes, len(image_list))
+
+        if missing_detections:
+            missing_images = [image_list[image_index] for image_index in missing_detections]
+
+            # Detect all the text bubbles and corresponding coordinates from the images
+            with metrics.timed('detection'):
+                all_raw_results = self.detector.detect(missing_images)
+
+            self.store_detections(all_bubble_data, missing_detections, all_raw_results, image_list, image_hashes, page_sizes)
+
+        return all_bubble_data
+
+
+    # Same as detect_pages, but the pages wait for the detection batcher on the event loop instead of holding a model thread
+    # That way the pages of every request in flight can end up in the same batch, run_blocking runs the cache and grouping work
+    async def detect_pages_async(self, image_list, image_hashes, page_sizes, run_blocking):
+        all_bubble_data, missing_detections = await run_blocking(self.cached_detections, image_hashes, len(image_list))
+
+        if missing_detections:
+            missing_images = [image_list[image_index] for image_index in missing_detections]
+
+            start = time.perf_counter()
+            futures = self.detection_batcher.submit(missing_images)
+            all_raw_results = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+            metrics.record('detection', time.perf_counter() - start)
+
+            await run_blocking(self.store_detections, all_bubble_data, missing_detections, all_raw_results, image_list, image_hashes, page_sizes)
+
+        return all_bubble_data
+
+
+    # Bubbles of the pages that are in the stage cache, and the indexes of the ones that still have to be detected
+    def cached_detections(self, image_hashes, num_pages):
+        all_bubble_data = [None] * num_pages
+
+        missing_detections = []
+        for image_index in range(num_pages):
+            cached_bubbles = None
+            if image_hashes is not None:
+                cached_bubbles = self.stage_cache.get(image_hashes[image_index], 'detection', self.detection_model_id)
+
+            if cached_bubbles is None:
+                missing_detections.append(image_index)
+            else:
+                all_bubble_data[image_index] = {bubble_index: bubble for bubble_index, bubble in cached_bubbles}
+
+        return all_bubble_data, missing_detections
+
+
+    # Group the raw detections of the pages that were missing into all_bubble_data and keep them in the stage cache
+    def store_detections(self, all_bubble_data, missing_detections, all_raw_results, image_list, image_hashes=None, page_sizes=None):
+        missing_sizes = [page_sizes[image_index] if page_sizes else image_list[image_index].size for image_index in missing_detections]
+        all_raw_results = [
+            self.scale_detections(raw_result, image_list[image_index].size, page_size)
+            for raw_result, image_index, page_size in zip(all_raw_results, missing_detections, missing_sizes)
+        ]
+
+        detected = self.structure_detections(all_raw_results, missing_sizes)
+        metrics.BUBBLES.inc(sum(len(image_text_data) for image_text_data in detected))
+        for position, image_index in enumerate(missing_detections):
+            all_bubble_data[image_index] = detected[position]
+
+            if image_hashes is not None:
+                # Stored as pairs since json would turn the bubble indexes into strings
+                self.stage_cache.put(image_hashes[image_index], 'detection', self.detection_model_id, list(detected[position].items()))
+
+
+    # Scale the boxes detected on a reduced page back to the coordinates of the full page
+    def scale_detections(self, raw_result, detected_size, page_size):
+        if detected_size == page_size:
+            return raw_result
+
+        scale_x = page_size[0] / detected_size[0]
+        scale_y = page_size[1] / detected_size[1]
+
+        scaled_result = dict(raw_result)
+        scaled_result['boxes'] = to_numpy(raw_result['boxes']) * np.array([scale_x, scale_y, scale_x, scale_y])
+        return scaled_result
+
 
-        print(f"DEBUG: Raw Detection Results: {all_raw_results}", flush=True)
+    # Fill the original_text of every bubble in place, pages whose text is in the stage cache skip the OCR model
+    def ocr_pages(self, all_bubble_data, image_list, image_hashes=None):
+        missing_texts = []
+        for image_index, image_text_data in enumerate(all_bubble_data):
+            cached_texts = None
+            if image_hashes is not None:
+                cached_texts = self.stage_cache.get(image_hashes[image_index], 'ocr', self.ocr_model_id)
 
-        # Structure, group and get the original text from the images
-        all_text_and_coord_data = self.get_text_data_from_detections(all_raw_results, image_list)
+            if cached_texts is None:
+                missing_texts.append(image_index)
+                continue
 
-        return all_text_and_coord_data
+            for bubble_index, text in cached_texts:
+                image_text_data[bubble_index]['original_text'] = text
+
+        if missing_texts:
+            self.extract_texts({image_index: all_bubble_data[image_index] for image_index in missing_texts}, image_list)
+
+            if image_hashes is not None:
+                for image_index in missing_texts:
+                    texts = [(bubble_index, bubble['original_text']) for bubble_index, bubble in all_bubble_data[image_index].items()]
+                    self.stage_cache.put(image_hashes[image_index], 'ocr', self.ocr_model_id, texts)
+
+        return all_bubble_data
     
     # This runs inpainting and rendering
     def inpaint_and_render(self, all_translated_data, image_list):
 
         # Inpaint the original text area
         cleaned_images = self.inpaint_images(all_translated_data, image_list)
-        # Render the final translated text onto the cleaned images
+        return self.render_pages(all_translated_data, cleaned_images)
+
+
+    # Render the final translated text onto the cleaned images
+    # page_indexes are the indexes of the pages in their request, only used to name the debug images
+    def render_pages(self, all_translated_data, cleaned_images, page_indexes=None):
         final_images = self.render_text(all_translated_data, cleaned_images)
         
-        self.debug_draw_boxes_raw(final_images, all_translated_data, save_prefix="debug_simple")
+        debug_path = debug.debug_dir()
+        if debug_path:
+            self.debug_draw_boxes_raw(final_images, all_translated_data, save_prefix="debug_simple", output_dir=debug_path, page_indexes=page_indexes)
         return final_images
     
 
+    # Runs the whole pipeline on the images of a request, the blocking stages run in the given executor
+    # Raises the error of the first page that failed
+    async def translate_images(self, image_list, translator_option, executor=None):
+        final_images = [None] * len(image_list)
+
+        # Closing the stream right away when a page fails cancels the other pages, instead of leaving them running until it gets garbage collected
+        async with aclosing(self.translate_images_stream(image_list, translator_option, executor)) as pages:
+            async for image_index, final_image, error, _ in pages:
+                if error is not None:
+                    raise error
+                final_images[image_index] = final_image
+
+        return final_images
+
+
+    # Pushes the pages through the page scheduler and yields them as soon as each one is done
+    # Yields (image_index, final_image, error, failed_lines) in the order the pages finish, error is None unless that page failed
+    # failed_lines counts the bubbles that kept their original text because the translator failed on them
+    async def translate_images_stream(self, image_list, translator_option, executor=None):
+        scheduler = PageScheduler(self, translator_option, executor)
+        async with aclosing(scheduler.run(image_list)) as results:
+            async for result in results:
+                yield result
+
+
     async def translate_from_folder(self):
         image_extensions = ('*.jpg', '*.jpeg', '*.png')
         image_paths = []
@@ -64,42 +265,36 @@ class MangaTranslationPipeline:
 
         image_list = [Image.open(path).convert('RGB') for path in image_paths]
 
-        all_text_data = self.detect_and_extract_text(image_list)
+        with debug.debug_request('folder'):
+            all_text_data = self.detect_and_extract_text(image_list)
 
-        all_translated_data = await self.translate_all_texts(all_text_data)
+            all_translated_data = await self.translate_all_texts(all_text_data)
 
-        final_images = self.inpaint_and_render(all_translated_data, image_list)
+            final_images = self.inpaint_and_render(all_translated_data, image_list)
 
         # Saving the final results
-        for i, final_image in enumerate(final_images):
-            original_filename = os.path.basename(image_paths[i])
-            filename, extension = os.path.splitext(original_filename)
-
-            output_filename = f'{filename}_translated{extension}'
-            output_path = os.path.join(config.OUTPUT_DIR, output_filename)
-
-            final_image.save(output_path)
+        output_filenames = []
+        for image_path in image_paths:
+            filename, extension = os.path.splitext(os.path.basename(image_path))
+            output_filenames.append(f'{filename}_translated{extension}')
+
+        output_paths = await asyncio.gather(*[
+            self.output_writer.save(final_image, output_filename)
+            for final_image, output_filename in zip(final_images, output_filenames)
+        ])
+        for output_path in output_paths:
             print(f'saved translated image to: {output_path}')
 
 
-    def get_text_data_from_detections(self, all_raw_results, image_list):
-        text_and_coords = {}
-        # First structure the raw result we got
-        for image_index, (image, single_image_results) in enumerate(zip(image_list, all_raw_results)):
-            detections = {}
-            max_width, max_height = image.size
-            for box_index, (score, label, coord) in enumerate(zip(single_image_results['scores'], single_image_results['labels'], single_image_results['boxes'])):
-                label_value = int(label.item())
-                detections[box_index] = {
-                    'label': self.bubble_map.get(label_value),
-                    'coordinates': [float(c) for c in coord],
-                    'confidance_score': float(score),
-                }
+    # Group the raw detections of every page into bubbles, returns a list with the bubbles of each page (without their text yet)
+    def structure_detections(self, all_raw_results, image_sizes):
+        all_bubble_data = []
 
-            # Group the bubbles
-            grouped_bubbles = group_by_iou(detections, iou_threshold=0.3)
+        # Group the bubbles of every page from the raw detection tensors
+        all_grouped_bubbles = group_detections_batch(all_raw_results, self.bubble_map, iou_threshold=config.IOU_THRESHOLD)
+
+        for (max_width, max_height), grouped_bubbles in zip(image_sizes, all_grouped_bubbles):
 
-            # Crop all the bubbles in this image and run OCR
             image_text_data = {}
             for bubble_index, data in grouped_bubbles.items():
                 if 'bubble' not in data:
@@ -109,21 +304,46 @@ class MangaTranslationPipeline:
                 text_bubble_coords = data.get('text_bubble', shrink_box(bubble_coords, max_width=max_width, max_height=max_height)) # Either get the text bubble coords, or if doesn't exist, use the shrink version of bubble coords
                 #text_bubble_coords = adjust_box_height(text_bubble_coords, bubble_coords) # Adjust and increase the height of the box if it is too small (For example, a single Jap word translating to english will make it appear small after rerender)
 
+                image_text_data[bubble_index] = {
+                    "bubble_coordinates": bubble_coords,
+                    "text_bubble_coordinates": text_bubble_coords,
+                    "original_text": "",
+                }
+
+            all_bubble_data.append(image_text_data)
+
+        return all_bubble_data
+
+
+    # Crop all the bubbles of the given pages and run OCR on all the crops at once, fills original_text in place
+    def extract_texts(self, text_and_coords, image_list):
+        crops = []
+        crop_keys = []
+
+        for image_index, image_text_data in text_and_coords.items():
+            image = image_list[image_index]
+            for bubble_index, bubble in image_text_data.items():
+                bubble_coords = bubble['bubble_coordinates']
+
                 if bubble_coords and len(bubble_coords) == 4:
                     crop = image.crop(bubble_coords)
                 else:
-                    crop = image.crop(text_bubble_coords)
+                    crop = image.crop(bubble['text_bubble_coordinates'])
 
-                text = self.ocr.extract_text(crop)
+                crops.append(crop)
+                crop_keys.append((image_index, bubble_index))
 
-                image_text_data[bubble_index] = {
-                    "bubble_coordinates": bubble_coords,
-                    "text_bubble_coordinates": text_bubble_coords,
-                    "original_text": text,
-                }
+        start = time.perf_counter()
+        texts = self.ocr.extract_text_batch(crops, batch_size=config.OCR_BATCH_SIZE)
+        elapsed = time.perf_counter() - start
 
-            text_and_coords[image_index] = image_text_data
-            print(text_and_coords)
+        metrics.record('ocr', elapsed)
+        if crops:
+            metrics.OCR_BATCH_SECONDS.observe(elapsed)
+            metrics.OCR_BATCH_CROPS.observe(len(crops))
+
+        for (image_index, bubble_index), text in zip(crop_keys, texts):
+            text_and_coords[image_index][bubble_index]['original_text'] = text
 
         return text_and_coords
     
@@ -135,13 +355,17 @@ class MangaTranslationPipeline:
             for bubble in img_data.values():
                 original_texts.append(bubble['original_text'])
 
-        translated_texts = await self.translator.translate_batch(original_texts, translator_option=translator_option)
+        with metrics.timed('translation'):
+            translated_texts = await self.translator.translate_batch(original_texts, translator_option=translator_option, fallback=False)
 
         translated_iter = iter(translated_texts)
 
         for img_data in all_text_data.values():
             for bubble in img_data.values():
-                bubble['translated_text'] = next(translated_iter, bubble['original_text']) # bubble['original_text'] serve as a fall back here in case translation failed
+                translated_text = next(translated_iter, None)
+                # bubble['original_text'] serve as a fall back here in case translation failed, the flag keeps the page out of the result cache
+                bubble['translation_failed'] = translated_text is None
+                bubble['translated_text'] = bubble['original_text'] if translated_text is None else translated_text
 
         return all_text_data
     
@@ -163,86 +387,185 @@ class MangaTranslationPipeline:
         return erased_images
     
 
-    def inpaint_images(self, text_and_coords, image_list):
-
-        stride = 8
+    def inpaint_images(self, text_and_coords, image_list, page_indexes=None):
 
-        inpainted_images = []
+        all_text_boxes = []
         for image_index, image in enumerate(image_list):
-            width, height = image.size
-            mask = Image.new('L', (width, height), 0) # L for grayscale
-            draw = ImageDraw.Draw(mask)
-
+            text_boxes = []
             if image_index in text_and_coords:
                 for bubble in text_and_coords[image_index].values():
                     coords_to_inpaint = bubble.get('text_bubble_coordinates')
                     if coords_to_inpaint:
                         #coords_to_inpaint = enlarge_box(coords_to_inpaint, width, height) # Enlarge the mask by a bit so that it has higher probability of not leaving any marks
-                        draw.rectangle(coords_to_inpaint, fill='white')
+                        text_boxes.append(coords_to_inpaint)
+            all_text_boxes.append(text_boxes)
 
-            # Pad to Stride required for LaMa model since the dimension needs to be divisible by 8
-            new_w = math.ceil(width/stride) * stride
-            new_h = math.ceil(height/stride) * stride
+        with metrics.timed('inpainting'):
+            if config.INPAINT_MODE == 'region':
+                inpainted_images = self.inpaint_regions(image_list, all_text_boxes)
+            else:
+                inpainted_images = self.inpaint_full_pages(image_list, all_text_boxes)
 
-            pad_w = new_w - width
-            pad_h = new_h - height
+        debug_path = debug.debug_dir()
+        if debug_path:
+            for image_index, final_image in enumerate(inpainted_images):
+                page_index = page_indexes[image_index] if page_indexes else image_index
+                final_image.save(os.path.join(debug_path, f'{page_index}_debug_inpainted.png'))
+        
+        return inpainted_images
 
-            if pad_w > 0 or pad_h > 0:
 
-                # Pad image with gray
-                img_padded = Image.new(image.mode, (new_w, new_h), (128, 128, 128))
-                img_padded.paste(image, (0, 0))
+    # Sends the whole pages to LaMa, pages of the same size go through the model together
+    def inpaint_full_pages(self, image_list, all_text_boxes):
+        padded_images = []
+        padded_masks = []
+        for image, text_boxes in zip(image_list, all_text_boxes):
+            mask = Image.new('L', image.size, 0) # L for grayscale
+            draw = ImageDraw.Draw(mask)
 
-                # Pad mask with black
-                mask_padded = Image.new(mask.mode, (new_w, new_h), 0)
-                mask_padded.paste(mask, (0, 0))
+            for coords_to_inpaint in text_boxes:
+                draw.rectangle(coords_to_inpaint, fill='white')
 
-            else:
-                img_padded = image
-                mask_padded = mask
-            
-            cleaned_image = self.inpainter.inpaint(img_padded, mask_padded)
+            img_padded, mask_padded = self.pad_to_stride(image, mask)
+            padded_images.append(img_padded)
+            padded_masks.append(mask_padded)
 
-            if pad_w > 0 or pad_h > 0:
-                final_image = cleaned_image.crop((0, 0, width, height))
-            else:
-                final_image = cleaned_image
+        cleaned_images = self.inpainter.inpaint_batch(padded_images, padded_masks)
 
-            final_image.save(os.path.join(config.OUTPUT_DIR, f'{image_index}_debug_inpainted.png'))
-            inpainted_images.append(final_image)
-        
-        return inpainted_images
+        final_images = []
+        for image, cleaned_image in zip(image_list, cleaned_images):
+            if cleaned_image.size != image.size:
+                cleaned_image = cleaned_image.crop((0, 0, image.width, image.height))
+            final_images.append(cleaned_image)
+
+        return final_images
+
+
+    # Only sends padded tiles around the text boxes to LaMa and pastes the cleaned pixels back into the pages
+    # The tiles of all the pages are inpainted together, tiles of the same size share a forward pass
+    def inpaint_regions(self, image_list, all_text_boxes):
+        results = [image.copy() for image in image_list]
+
+        tiles = []
+        tile_masks = []
+        placements = []
+        for image_index, (image, text_boxes) in enumerate(zip(image_list, all_text_boxes)):
+            width, height = image.size
+
+            regions = merge_into_regions(
+                text_boxes,
+                max_width=width,
+                max_height=height,
+                margin=config.INPAINT_REGION_MARGIN,
+                merge_distance=config.INPAINT_REGION_MERGE_DISTANCE,
+                max_tile_size=config.INPAINT_MAX_TILE_SIZE,
+            )
+
+            for region in regions:
+                # Rounded up to the tile bucket so more tiles end up with the same size and can be batched
+                x1, y1, x2, y2 = self.align_region_to_stride(region, width, height, stride=config.INPAINT_TILE_BUCKET)
+                tile = image.crop((x1, y1, x2, y2))
+
+                # Mask only for the text boxes inside this tile, shifted into the tile's coordinates
+                # Tiles can overlap, a box cut by the edge of this tile is left to the tile it's whole in, where the model sees around it
+                tile_mask = Image.new('L', tile.size, 0)
+                draw = ImageDraw.Draw(tile_mask)
+                for box in text_boxes:
+                    if not box_inside(box, (x1, y1, x2, y2), width, height):
+                        continue
+                    draw.rectangle([box[0] - x1, box[1] - y1, box[2] - x1, box[3] - y1], fill='white')
+
+                tile_padded, mask_padded = self.pad_to_stride(tile, tile_mask)
+                tiles.append(tile_padded)
+                tile_masks.append(mask_padded)
+                placements.append((image_index, x1, y1, tile.size, tile_mask))
+
+        if not tiles:
+            return results
+
+        cleaned_tiles = self.inpainter.inpaint_batch(tiles, tile_masks)
+
+        for (image_index, x1, y1, tile_size, tile_mask), cleaned_tile in zip(placements, cleaned_tiles):
+            if cleaned_tile.size != tile_size:
+                cleaned_tile = cleaned_tile.crop((0, 0, tile_size[0], tile_size[1]))
+
+            # Only the masked pixels are replaced, everything else in the tile stays untouched
+            results[image_index].paste(cleaned_tile, (x1, y1), tile_mask)
+
+        return results
+
+
+    # Grow a region so its dimensions are divisible by the stride, using real image content instead of padding when possible
+    def align_region_to_stride(self, region, width, height, stride=None):
+        stride = stride or config.INPAINT_STRIDE
+        x1, y1, x2, y2 = region
+
+        extra_w = (-(x2 - x1)) % stride
+        x2 = min(width, x2 + extra_w)
+        x1 = max(0, x1 - (extra_w - (x2 - region[2])))
+
+        extra_h = (-(y2 - y1)) % stride
+        y2 = min(height, y2 + extra_h)
+        y1 = max(0, y1 - (extra_h - (y2 - region[3])))
+
+        return x1, y1, x2, y2
+
+
+    # Pad to Stride required for LaMa model since the dimension needs to be divisible by 8
+    def pad_to_stride(self, image, mask):
+        stride = config.INPAINT_STRIDE
+        width, height = image.size
+
+        new_w = math.ceil(width/stride) * stride
+        new_h = math.ceil(height/stride) * stride
+
+        if new_w == width and new_h == height:
+            return image, mask
+
+        # Pad image with gray
+        img_padded = Image.new(image.mode, (new_w, new_h), (128, 128, 128))
+        img_padded.paste(image, (0, 0))
+
+        # Pad mask with black
+        mask_padded = Image.new(mask.mode, (new_w, new_h), 0)
+        mask_padded.paste(mask, (0, 0))
+
+        return img_padded, mask_padded
 
 
 
     def render_text(self, all_translated_data, inpainted_images):
         final_images = []
 
-        for image_index, image in enumerate(inpainted_images):
-            draw = ImageDraw.Draw(image)
-            if image_index in all_translated_data:
-                for bubble in all_translated_data[image_index].values():
-                    if bubble['text_bubble_coordinates']:
-                        translated_text = bubble.get('translated_text', "")
-
-                        bubble['translated_text'] = translated_text
-                        draw_text_in_box(draw, bubble['text_bubble_coordinates'], bubble['translated_text'], config.FONT_PATH)
-            
-            final_images.append(image)
+        with metrics.timed('rendering'):
+            for image_index, image in enumerate(inpainted_images):
+                draw = ImageDraw.Draw(image)
+                if image_index in all_translated_data:
+                    for bubble in all_translated_data[image_index].values():
+                        if bubble['text_bubble_coordinates']:
+                            translated_text = bubble.get('translated_text', "")
+
+                            bubble['translated_text'] = translated_text
+                            start = time.perf_counter()
+                            draw_text_in_box(draw, bubble['text_bubble_coordinates'], bubble['translated_text'], config.FONT_PATH)
+                            metrics.DRAW_TEXT_SECONDS.observe(time.perf_counter() - start)
+                
+                final_images.append(image)
         
         return final_images
     
 
 
     # AI generated function to draw boxes around detected boxes for me to debug, didn't proofread the codes or anything 
-    def debug_draw_boxes_raw(self, images, all_translated_data, save_prefix="debug"):
+    def debug_draw_boxes_raw(self, images, all_translated_data, save_prefix="debug", output_dir=None, page_indexes=None):
         """
         - images: list of PIL.Image objects (inpainted_images or final_images)
         - all_translated_data: mapping image_index -> {bubble_index: {...}}
-        - saves images to config.OUTPUT_DIR named {save_prefix}_img_{i}.png
+        - saves images to output_dir (config.OUTPUT_DIR by default) named {save_prefix}_img_{i}.png, i being the page index when given
         """
 
-        os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+        output_dir = output_dir or config.OUTPUT_DIR
+        os.makedirs(output_dir, exist_ok=True)
 
         for img_idx, img in enumerate(images):
             out_img = img.copy()
@@ -285,9 +608,238 @@ class MangaTranslationPipeline:
                     preview = (translated or original)[:140].replace("\n", " ")
                     print(f"[debug_simple] img={img_idx} bubble={bubble_idx} bubble_coords={bubble_coords} text_coords={text_coords} preview='{preview}'", flush=True)
 
-            out_path = os.path.join(config.OUTPUT_DIR, f"{save_prefix}_img_{img_idx}.png")
+            page_idx = page_indexes[img_idx] if page_indexes else img_idx
+            out_path = os.path.join(output_dir, f"{save_prefix}_img_{page_idx}.png")
             try:
                 out_img.save(out_path)
                 print(f"[debug_simple] saved {out_path}", flush=True)
             except Exception as e:
                 print(f"[debug_simple] failed to save img {img_idx}: {e}", flush=True)
+
+
+
+# Marks the end of the pages in the scheduler queues
+END_OF_PAGES = object()
+
+
+# Runs every page of a request through the detect, OCR, translate and render stages, connected by bounded queues
+# Each stage works on whatever pages are ready, so page N can be rendered while page N+1 waits on the translator
+# Inpainting only needs the detected boxes, so it starts right after detection and runs alongside OCR and translation on its own thread
+# The blocking stages run in the executor, translation stays on the event loop and is batched across the pages that are ready
+class PageScheduler:
+    def __init__(self, pipeline, translator_option, executor=None):
+        self.pipeline = pipeline
+        self.translator_option = translator_option
+        self.executor = executor
+
+        self.ocr_queue = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        self.translate_queue = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        self.render_queue = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        self.output_queue = asyncio.Queue()
+        self.inpaint_tasks = []
+
+    async def run(self, image_list):
+        if not image_list:
+            return
+
+        stages = [
+            asyncio.create_task(self.detect_stage(image_list)),
+            asyncio.create_task(self.ocr_stage()),
+            asyncio.create_task(self.translate_stage()),
+            asyncio.create_task(self.render_stage()),
+        ]
+
+        metrics.PAGES_IN_FLIGHT.inc(len(image_list))
+        pages_out = 0
+        try:
+            # Every page comes out exactly once, either rendered or with its error
+            for _ in range(len(image_list)):
+                result = await self.output_queue.get()
+                pages_out += 1
+                metrics.PAGES_IN_FLIGHT.dec()
+                metrics.PAGES.labels('failed' if result[2] is not None else 'done').inc()
+                yield result
+        finally:
+            metrics.PAGES_IN_FLIGHT.dec(len(image_list) - pages_out)
+            # Also reached when the consumer goes away, no need to keep working on pages nobody will receive
+            tasks = stages + self.inpaint_tasks
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run_blocking(self, fn, *args, executor=None):
+        loop = asyncio.get_running_loop()
+        # run_in_executor doesn't carry the context over, the stage timings of the request need it
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor or self.executor, functools.partial(context.run, fn, *args))
+
+    async def fail(self, pages, error):
+        for page in pages:
+            if 'inpainted' in page:
+                page['inpainted'].cancel()
+            await self.output_queue.put((page['index'], None, error, 0))
+
+    # Wait for one page, then take every other page that is already waiting, up to max_pages
+    # Returns the pages and whether the end of the pages was reached
+    async def take_ready(self, queue, max_pages):
+        pages = []
+        first = await queue.get()
+        if first is END_OF_PAGES:
+            return pages, True
+        pages.append(first)
+
+        while len(pages) < max_pages and not queue.empty():
+            page = queue.get_nowait()
+            if page is END_OF_PAGES:
+                return pages, True
+            pages.append(page)
+
+        return pages, False
+
+    # Spooled uploads are only decoded here, one group at a time, so the decoded pages in memory scale with the queue sizes
+    # JPEG uploads are detected on a reduced decode, the full page is decoded once the detector is done with it
+    def load_for_detection(self, pages):
+        with metrics.timed('decode'):
+            self.load_sources(pages)
+
+    def load_sources(self, pages):
+        for page in pages:
+            source = page['source']
+
+            if isinstance(source, SpooledPage):
+                page['size'] = source.size
+                draft = source.load_draft(config.UPLOAD_DRAFT_SIZE) if config.UPLOAD_DRAFT_DETECTION else None
+                if draft is not None:
+                    page['detection_image'] = draft
+                else:
+                    page['image'] = page['detection_image'] = source.load()
+            else:
+                page['size'] = source.size
+                page['image'] = page['detection_image'] = source
+
+            page['hash'] = None
+            if self.pipeline.stage_cache is not None:
+                # The file hash is as good as the pixels hash for the stage cache and doesn't need the decoded page
+                page['hash'] = source.content_hash if isinstance(source, SpooledPage) else hash_image(page['image'])
+
+    def load_full_pages(self, pages):
+        with metrics.timed('decode'):
+            for page in pages:
+                page.pop('detection_image', None)
+                if 'image' not in page:
+                    page['image'] = page['source'].load()
+
+    async def detect(self, images, image_hashes, page_sizes):
+        if self.pipeline.detection_batcher is None:
+            return await self.run_blocking(self.pipeline.detect_pages, images, image_hashes, page_sizes)
+        return await self.pipeline.detect_pages_async(images, image_hashes, page_sizes, self.run_blocking)
+
+    async def detect_stage(self, image_list):
+        if self.pipeline.detection_batcher is None:
+            await self.detect_all(image_list)
+            return
+
+        # Lets the batcher know another request may send pages, so it's worth waiting for them
+        with self.pipeline.detection_batcher.caller():
+            await self.detect_all(image_list)
+
+    async def detect_all(self, image_list):
+        # A few pages at a time so the detector still gets batched inputs
+        group_size = config.PIPELINE_DETECT_BATCH_PAGES
+        for start in range(0, len(image_list), group_size):
+            pages = [
+                {'index': image_index, 'source': source}
+                for image_index, source in enumerate(image_list[start:start + group_size], start=start)
+            ]
+
+            try:
+                await self.run_blocking(self.load_for_detection, pages)
+
+                image_hashes = [page['hash'] for page in pages] if self.pipeline.stage_cache is not None else None
+                all_bubble_data = await self.detect(
+                    [page['detection_image'] for page in pages],
+                    image_hashes,
+                    [page['size'] for page in pages],
+                )
+
+                await self.run_blocking(self.load_full_pages, pages)
+            except Exception as e:
+                await self.fail(pages, e)
+                continue
+
+            for position, page in enumerate(pages):
+                page['data'] = all_bubble_data[position]
+                page['inpainted'] = self.start_inpainting(page)
+                await self.ocr_queue.put(page)
+
+        await self.ocr_queue.put(END_OF_PAGES)
+
+    async def ocr_stage(self):
+        done = False
+        while not done:
+            pages, done = await self.take_ready(self.ocr_queue, config.PIPELINE_OCR_BATCH_PAGES)
+            if not pages:
+                continue
+
+            images = [page['image'] for page in pages]
+            image_hashes = [page['hash'] for page in pages] if self.pipeline.stage_cache is not None else None
+
+            try:
+                await self.run_blocking(self.pipeline.ocr_pages, [page['data'] for page in pages], images, image_hashes)
+            except Exception as e:
+                await self.fail(pages, e)
+                continue
+
+            for page in pages:
+                await self.translate_queue.put(page)
+
+        await self.translate_queue.put(END_OF_PAGES)
+
+    async def translate_stage(self):
+        done = False
+        while not done:
+            # Everything that piled up while the previous request was in flight goes out together
+            pages, done = await self.take_ready(self.translate_queue, config.PIPELINE_TRANSLATION_BATCH_PAGES)
+            if not pages:
+                continue
+
+            try:
+                await self.pipeline.translate_all_texts({page['index']: page['data'] for page in pages}, self.translator_option)
+            except Exception as e:
+                await self.fail(pages, e)
+                continue
+
+            for page in pages:
+                await self.render_queue.put(page)
+
+        await self.render_queue.put(END_OF_PAGES)
+
+    # Inpaint the page in the background, the render stage joins it once the page is translated
+    def start_inpainting(self, page):
+        # Only the boxes, so OCR and translation can keep filling in the bubbles while this runs in another thread
+        text_boxes = {
+            bubble_index: {'text_bubble_coordinates': bubble['text_bubble_coordinates']}
+            for bubble_index, bubble in page['data'].items()
+        }
+        task = asyncio.create_task(self.run_blocking(
+            self.pipeline.inpaint_images, {0: text_boxes}, [page['image']], [page['index']],
+            executor=self.pipeline.inpaint_executor,
+        ))
+        self.inpaint_tasks.append(task)
+        return task
+
+    async def render_stage(self):
+        while True:
+            page = await self.render_queue.get()
+            if page is END_OF_PAGES:
+                return
+
+            try:
+                cleaned_images = await page['inpainted']
+                final_images = await self.run_blocking(self.pipeline.render_pages, {0: page['data']}, cleaned_images, [page['index']])
+            except Exception as e:
+                await self.fail([page], e)
+                continue
+
+            failed_lines = sum(bubble.get('translation_failed', False) for bubble in page['data'].values())
+            await self.output_queue.put((page['index'], final_images[0], None, failed_lines))
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from app import config
+
+
+# Backends of all the models, part of the cache keys since int8/onnx outputs differ slightly from eager
+# Lives here and not in inference_backends so the server doesn't import torch on startup
+def inference_backends_id():
+    return ','.join(f'{name}={backend}' for name, backend in sorted(config.INFERENCE_BACKENDS.items()))
+
+
+# Persistent cache of fully translated pages, keyed by the hash of the uploaded file, the translator and the config version
+# The rendered files live in RESULT_CACHE_DIR and a small SQLite index keeps their size and last access for the LRU eviction
+class ResultCache:
+    def __init__(self, cache_dir=None, index_path=None, max_bytes=None):
+        self.cache_dir = cache_dir or config.RESULT_CACHE_DIR
+        self.index_path = index_path or config.RESULT_CACHE_INDEX_PATH
+        self.max_bytes = max_bytes or config.RESULT_CACHE_MAX_BYTES
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+
+        # The cache is used from the event loop and the worker threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, content_hash, translator_option, *extra):
+        parts = [content_hash, str(translator_option), config.CONFIG_VERSION, *map(str, extra)]
+        return hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+
+    # Returns the path of the cached file or None
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT file_name FROM results WHERE key = ?', (key,)).fetchone()
+
+            if row:
+                path = os.path.join(self.cache_dir, row[0])
+
+                # The file was deleted behind our back, treat it as a miss
+                if not os.path.exists(path):
+                    self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self.db.commit()
+                    row = None
+
+            if not row:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            return path
+
+    # Copy a rendered file into the cache
+    def put(self, key, source_path):
+        extension = os.path.splitext(source_path)[1]
+        file_name = f'{key}{extension}'
+        path = os.path.join(self.cache_dir, file_name)
+
+        shutil.copyfile(source_path, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO results (key, file_name, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, file_name, size, time.time())
+            )
+            self.db.commit()
+            self.evict()
+
+    # Remove the least recently used files until the cache fits in max_bytes, expects the lock to be held
+    def evict(self):
+        total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+
+        for key, file_name, size in self.db.execute('SELECT key, file_name, size FROM results ORDER BY last_access ASC').fetchall():
+            if total_size <= self.max_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+
+            self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+            total_size -= size
+
+        self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries, total_size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'sizeBytes': total_size,
+            'maxBytes': self.max_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from app import config
+
+
+# Hash of the decoded pixels, the same page gives the same hash no matter how it was encoded or named
+def hash_image(image):
+    digest = hashlib.sha256()
+    digest.update(f'{image.mode}:{image.size[0]}x{image.size[1]}:'.encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+# Persistent store for the intermediate results of the vision stages (detections, OCR text) of each page
+# Entries are keyed by (image hash, stage, model id) so changing a model or its settings never reuses stale results
+class StageCache:
+    def __init__(self, path=None, max_entries=None):
+        self.path = path or config.STAGE_CACHE_PATH
+        self.max_entries = max_entries or config.STAGE_CACHE_MAX_ENTRIES
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Used from the model worker threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS stage_results (
+                image_hash TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (image_hash, stage, model_id)
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS stage_results_created_at ON stage_results (created_at)')
+        self.db.commit()
+
+        self.puts_since_prune = 0
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, image_hash, stage, model_id):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM stage_results WHERE image_hash = ? AND stage = ? AND model_id = ?',
+                (image_hash, stage, model_id)
+            ).fetchone()
+
+            counter = self.hits if row else self.misses
+            counter[stage] = counter.get(stage, 0) + 1
+
+        return json.loads(row[0]) if row else None
+
+    def put(self, image_hash, stage, model_id, data):
+        encoded = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO stage_results (image_hash, stage, model_id, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                (image_hash, stage, model_id, encoded, time.time())
+            )
+
+            # Drop the oldest entries once the store is over its limit, checked every so often since it scans the table
+            self.puts_since_prune += 1
+            if self.puts_since_prune >= config.STAGE_CACHE_PRUNE_INTERVAL:
+                self.puts_since_prune = 0
+                self.db.execute('''
+                    DELETE FROM stage_results WHERE rowid IN (
+                        SELECT rowid FROM stage_results ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM stage_results').fetchone()[0]
+        return {
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'entries': entries,
+            'maxEntries': self.max_entries,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
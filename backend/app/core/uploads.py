@@ -0,0 +1,58 @@
+import hashlib
+import os
+import tempfile
+from PIL import Image
+from app import config
+
+
+# An uploaded page spooled to disk, only decoded when the pipeline gets to it
+class SpooledPage:
+    def __init__(self, path, content_hash):
+        self.path = path
+        self.content_hash = content_hash
+
+        # Only reads the header
+        with Image.open(path) as image:
+            self.size = image.size
+            self.format = image.format
+
+    def load(self):
+        with Image.open(self.path) as image:
+            return image.convert("RGB")
+
+    # JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale, the smallest one that is still at least min_size is used
+    # Returns None for the other formats since they can only be decoded in full
+    def load_draft(self, min_size):
+        if self.format != 'JPEG':
+            return None
+
+        with Image.open(self.path) as image:
+            image.draft('RGB', min_size)
+            return image.convert("RGB")
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# Copy an upload to a temporary file chunk by chunk, hashing it on the way, so the whole file is never held in memory
+async def spool_upload(file):
+    digest = hashlib.sha256()
+    _, extension = os.path.splitext(file.filename or '')
+
+    fd, path = tempfile.mkstemp(suffix=extension, dir=config.UPLOAD_SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as spooled:
+            while True:
+                chunk = await file.read(config.UPLOAD_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                spooled.write(chunk)
+
+        return SpooledPage(path, digest.hexdigest())
+    except Exception:
+        os.remove(path)
+        raise
@@ -1,7 +1,9 @@
 print("[BubbleDetector] importing transformers/torch - this can take a while", flush=True)
 from transformers import RTDetrV2ForObjectDetection, RTDetrImageProcessor
+from types import SimpleNamespace
 import torch
 from app import config
+from app.processing import inference_backends
 import os
 print("[BubbleDetector] transformers/torch imported", flush=True)
 
@@ -14,17 +16,89 @@ class BubbleDetector:
         self.processor = RTDetrImageProcessor.from_pretrained(config.DETECTOR_MODEL_ID)
         self.model = RTDetrV2ForObjectDetection.from_pretrained(config.DETECTOR_MODEL_ID).to(config.DEVICE)
         self.device = config.DEVICE
+        self.input_size = self.get_input_size()
+
+        self.backend = inference_backends.inference_backend('detector', ('eager', 'int8', 'compiled', 'onnx'))
+        self.onnx_session = None
+        if self.backend == 'int8':
+            self.model = inference_backends.quantize_dynamic(self.model)
+        elif self.backend == 'compiled':
+            # The ResNet backbone runs faster on NHWC inputs
+            self.model = inference_backends.compile_forward(self.model, channels_last=True)
+        elif self.backend == 'onnx':
+            self.onnx_path = self.export_onnx()
+            self.onnx_session = inference_backends.onnx_session(self.onnx_path)
+            # onnxruntime has its own copy of the weights
+            self.model = None
+
+
+    # (width, height) the processor resizes every page to, None when it keeps the aspect ratio instead
+    def get_input_size(self):
+        size = self.processor.size or {}
+        if not self.processor.do_resize or 'height' not in size or 'width' not in size:
+            return None
+        return (size['width'], size['height'])
+
+
+    # Exported with the logits and boxes as plain outputs, post_process_object_detection only needs those two
+    def export_onnx(self):
+        width, height = self.input_size or (640, 640)
+        path = inference_backends.optimized_model_path(f'{config.DETECTOR_MODEL_ID}-{width}x{height}', 'onnx')
+
+        dynamic_axes = {'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}, 'pred_boxes': {0: 'batch'}}
+        if self.input_size is None:
+            dynamic_axes['pixel_values'].update({2: 'height', 3: 'width'})
+
+        return inference_backends.export_onnx(
+            DetectorOutputs(self.model.eval()), (torch.zeros(1, 3, height, width),), path,
+            input_names=['pixel_values'], output_names=['logits', 'pred_boxes'], dynamic_axes=dynamic_axes,
+        )
+
+
+    def run_model(self, inputs):
+        if self.onnx_session is not None:
+            logits, pred_boxes = self.onnx_session.run(None, {'pixel_values': inputs['pixel_values'].numpy()})
+            return SimpleNamespace(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(pred_boxes))
+
+        if self.backend == 'compiled':
+            inputs['pixel_values'] = inputs['pixel_values'].to(memory_format=torch.channels_last)
+
+        with torch.no_grad():
+            return self.model(**inputs)
+
+
+    def preprocess(self, image_list):
+        if self.input_size is None:
+            return self.processor(images=image_list, return_tensors='pt')
+
+        # Same resize the processor does, but done by PIL on the page itself so the full resolution page never gets converted to numpy
+        resized = [
+            image.resize(self.input_size, resample=self.processor.resample, reducing_gap=config.DETECTION_RESIZE_REDUCING_GAP)
+            for image in image_list
+        ]
+        return self.processor(images=resized, do_resize=False, return_tensors='pt')
 
 
     def detect(self, image_list):
         # processing input
-        input = self.processor(images=image_list, return_tensors='pt').to(self.device)
+        input = self.preprocess(image_list).to(self.device)
 
         # inference
-        with torch.no_grad():
-            outputs = self.model(**input)
+        outputs = self.run_model(input)
 
+        # The predicted boxes are relative to the page, so scaling them by the original sizes puts them back in full resolution coordinates
         target_sizes = torch.tensor([img.size[::-1] for img in image_list], device=self.device)
         results = self.processor.post_process_object_detection(outputs, target_sizes=target_sizes, threshold=config.DETECTION_CONFIDENCE)
 
         return results
+
+
+# Plain tuple outputs for the ONNX export instead of a ModelOutput
+class DetectorOutputs(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        outputs = self.model(pixel_values=pixel_values)
+        return outputs.logits, outputs.pred_boxes
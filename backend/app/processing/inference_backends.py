@@ -0,0 +1,93 @@
+import os
+import re
+import torch
+from app import config
+
+# Backends that only make sense on CPU, a GPU runs the eager model instead
+CPU_ONLY_BACKENDS = {'int8', 'onnx'}
+
+
+# Backend configured for a model, eager when the model does not support it or it doesn't apply to the device
+def inference_backend(model_name, supported):
+    backend = config.INFERENCE_BACKENDS.get(model_name, 'eager')
+
+    if backend not in supported:
+        print(f"[{model_name}] '{backend}' backend is not supported, use one of {', '.join(supported)}. Running eager instead", flush=True)
+        return 'eager'
+    if backend in CPU_ONLY_BACKENDS and config.DEVICE != 'cpu':
+        print(f"[{model_name}] '{backend}' backend is CPU only. Running eager on {config.DEVICE} instead", flush=True)
+        return 'eager'
+
+    print(f"[{model_name}] Using the {backend} backend", flush=True)
+    return backend
+
+
+# Path of an exported model in OPTIMIZED_MODEL_DIR, exports depend on the torch version that made them
+def optimized_model_path(name, extension):
+    os.makedirs(config.OPTIMIZED_MODEL_DIR, exist_ok=True)
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+    return os.path.join(config.OPTIMIZED_MODEL_DIR, f'{name}-torch{torch.__version__}.{extension}')
+
+
+# Runs export_fn(tmp_path) once and returns the path of the export, later calls (and processes) reuse the file
+def cached_export(path, export_fn):
+    if os.path.exists(path):
+        return path
+
+    print(f"Exporting {os.path.basename(path)}, this only happens once", flush=True)
+    # Several worker processes can export at the same time, the file only appears once it's complete
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        export_fn(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+# Weights of the Linear layers stored as int8, activations quantized on the fly. Conv layers are left as they are
+def quantize_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+# Compiles the forward of a Hugging Face model in place, generate() and the processors keep working with the same object
+# Compilation happens on the first call, which is why the model loader warms the models up
+def compile_forward(model, channels_last=False):
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+# Frozen and inference-optimized copy of a TorchScript model, weights become constants and conv/bn get fused
+def freeze_torchscript(model, path):
+    def export(tmp_path):
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(model.eval()))
+        torch.jit.save(frozen, tmp_path)
+
+    return torch.jit.load(cached_export(path, export), map_location=config.DEVICE)
+
+
+def export_onnx(module, example_inputs, path, input_names, output_names, dynamic_axes=None):
+    def export(tmp_path):
+        with torch.no_grad():
+            torch.onnx.export(
+                module, example_inputs, tmp_path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=config.ONNX_OPSET,
+            )
+
+    return cached_export(path, export)
+
+
+# onnxruntime session that uses as many threads as torch was given, so worker processes still split the cores
+def onnx_session(path):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
@@ -1,16 +1,29 @@
 print("[InPainter] importing transformers/torch - this can take a while", flush=True)
 import os
+import threading
+import warnings
+from collections import OrderedDict
 import torch
 import numpy as np
 from PIL import Image
 from app import config
 from app.utils.utils import download_models
+from app.processing import inference_backends
 print("[InPainter] transformers/torch imported", flush=True)
 
+# PIL hands out read-only buffers, the tensors made from them are only ever read from
+warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+
 
 class InPainter:
-    def __init__(self):
-        self.model = self.load_model()
+    def __init__(self, model=None):
+        # LaMa is convolutions and FFTs: dynamic int8 only quantizes Linear layers and the FFTs have no ONNX export, so only eager and compiled
+        self.backend = 'eager' if model is not None else inference_backends.inference_backend('inpainter', ('eager', 'compiled'))
+        self.model = model if model is not None else self.load_model()
+        self.memory_format = torch.channels_last if self.backend == 'compiled' else torch.contiguous_format
+
+        # Input/output buffers of the last shapes seen, per thread since several model threads can inpaint at the same time
+        self.buffers = threading.local()
 
     
     def load_model(self):
@@ -22,6 +35,13 @@ class InPainter:
             model = torch.jit.load(config.CACHED_INPAINTER_MODEL_PATH, map_location=config.DEVICE)
             model.eval()
             model.to(config.DEVICE)
+
+            if self.backend == 'compiled':
+                # A new download of the model gets a new mtime, so a frozen copy of the old one is never reused
+                mtime = int(os.path.getmtime(config.CACHED_INPAINTER_MODEL_PATH))
+                path = inference_backends.optimized_model_path(f'{os.path.splitext(config.CACHED_INPAINTER_MODEL)[0]}-{mtime}-frozen-{config.DEVICE}', 'pt')
+                model = inference_backends.freeze_torchscript(model, path)
+
             return model
 
         except Exception as e:
@@ -30,36 +50,81 @@ class InPainter:
         
     
     def inpaint(self, image: Image.Image, mask: Image.Image) -> Image.Image:
+        return self.inpaint_same_size([image], [mask])[0]
+
+
+    # Inpaint many image/mask pairs, the ones with the same size are stacked and go through the model together
+    # Each forward pass stays under max_batch_pixels, a single input bigger than that still goes through on its own
+    def inpaint_batch(self, images, masks, max_batch_pixels=None):
+        max_batch_pixels = max_batch_pixels or config.INPAINT_BATCH_MAX_PIXELS
+
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(image.size, []).append(index)
+
+        results = [None] * len(images)
+        for (width, height), indexes in groups.items():
+            per_batch = max(1, max_batch_pixels // (width * height))
+
+            for start in range(0, len(indexes), per_batch):
+                batch_indexes = indexes[start:start + per_batch]
+                outputs = self.inpaint_same_size([images[index] for index in batch_indexes], [masks[index] for index in batch_indexes])
 
-        # Convert PIL to Numpy and Normalize it to 0.0 - 1.0 values
-        img_np = np.array(image).astype('float32') / 255.0
-        mask_np = np.array(mask).astype('float') / 255.0
+                for index, output in zip(batch_indexes, outputs):
+                    results[index] = output
 
-        # Binarize mask
-        mask_np = (mask_np > 0.5).astype('float32')
+        return results
 
-        # Prepare tensors
-        # Image: HWC -> CHW -> Add Batch Dimensions(size) -> move to device
-        img_tensor = torch.from_numpy(img_np).permute(2, 0, 1).unsqueeze(0).to(config.DEVICE)
 
-        # Mask: HW -> Add Batch and Channel Dimensions (1, 1, H, W) -> Move to device
-        if len(mask_np.shape) == 2:
-            mask_tensor = torch.from_numpy(mask_np).unsqueeze(0).unsqueeze(0).to(config.DEVICE)
-        else:
-            mask_tensor = torch.from_numpy(mask_np).permute(2, 0, 1).unsqueeze(0).to(config.DEVICE)
+    # Float input, mask and uint8 output buffers for a (batch, height, width), reused as long as that shape keeps coming back
+    def get_buffers(self, batch_size, height, width):
+        cache = getattr(self.buffers, 'cache', None)
+        if cache is None:
+            cache = self.buffers.cache = OrderedDict()
 
+        key = (batch_size, height, width)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key][0]
+
+        buffers = (
+            torch.empty((batch_size, 3, height, width), dtype=torch.float32, device=config.DEVICE, memory_format=self.memory_format),
+            torch.empty((batch_size, 1, height, width), dtype=torch.float32, device=config.DEVICE, memory_format=self.memory_format),
+            torch.empty((batch_size, height, width, 3), dtype=torch.uint8),
+        )
+
+        # Capped in bytes rather than shapes, a single full spread is already ~150 MB of buffers
+        # Anything bigger than the cap is allocated for this call only and freed right after
+        size = sum(tensor.numel() * tensor.element_size() for tensor in buffers)
+        if size <= config.INPAINT_BUFFER_CACHE_BYTES:
+            cache[key] = (buffers, size)
+            while sum(cached_size for _, cached_size in cache.values()) > config.INPAINT_BUFFER_CACHE_BYTES:
+                cache.popitem(last=False)
+
+        return buffers
+
+
+    # Single forward pass on images that all have the same size
+    # The pages stay uint8 until they are copied into the float buffer, normalizing and binarizing happen in place
+    def inpaint_same_size(self, images, masks):
+        width, height = images[0].size
+        img_tensor, mask_tensor, output_buffer = self.get_buffers(len(images), height, width)
+
+        for index, (image, mask) in enumerate(zip(images, masks)):
+            # HWC uint8 view of the page, converted to float while it is copied into the CHW buffer
+            img_tensor[index].copy_(torch.from_numpy(np.asarray(image)).permute(2, 0, 1))
+            # Binarized straight from the uint8 values (same as > 0.5 after normalizing)
+            mask_tensor[index, 0].copy_(torch.from_numpy(np.asarray(mask) > 127))
+
+        img_tensor.div_(255.0)
 
         # Inference
         with torch.no_grad():
             output = self.model(img_tensor, mask_tensor)
 
-        # Post process: Tensor -> Numpy -> PIL
-        # Removing batch dimensions -> CHW ->HWC
-        res_img = output[0].permute(1, 2, 0).detach().cpu().numpy()
-
-        # Clip to 0-255 and converts to uint8
-        res_img = np.clip(res_img * 255, 0, 255).astype("uint8")
+        # Post process: scaled and clipped in place, then NCHW -> NHWC straight into the uint8 buffer
+        output.mul_(255).clamp_(0, 255)
+        output_buffer.copy_(output.permute(0, 2, 3, 1))
 
-        return Image.fromarray(res_img)
-            
-            
\ No newline at end of file
+        # PIL copies the pixels, so the buffer can be reused by the next call
+        return [Image.fromarray(res_img) for res_img in output_buffer.numpy()]
@@ -1,10 +1,43 @@
 from manga_ocr import MangaOcr
+from manga_ocr.ocr import post_process
+import torch
+from app import config
+from app.processing import inference_backends
 
 class OcrProcessor():
     def __init__(self):
-        self.mocr = MangaOcr()
+        self.mocr = MangaOcr(config.OCR_MODEL_ID)
+
+        # generate() runs the decoder step by step, which has no simple ONNX export, so no onnx backend here
+        self.backend = inference_backends.inference_backend('ocr', ('eager', 'int8', 'compiled'))
+        if self.backend == 'int8':
+            # The ViT encoder and BERT decoder are almost only Linear layers
+            self.mocr.model = inference_backends.quantize_dynamic(self.mocr.model)
+        elif self.backend == 'compiled':
+            self.mocr.model = inference_backends.compile_forward(self.mocr.model)
 
     def extract_text(self, text):
         return self.mocr(text)
 
-    
\ No newline at end of file
+    # Run OCR on a list of PIL crops, batch_size crops go through the encoder/decoder in a single generate call
+    def extract_text_batch(self, crops, batch_size=None):
+        if not crops:
+            return []
+
+        batch_size = batch_size or config.OCR_BATCH_SIZE
+
+        texts = []
+        for start in range(0, len(crops), batch_size):
+            batch = crops[start:start + batch_size]
+
+            # Same preprocessing MangaOcr does for a single image
+            batch = [crop.convert('L').convert('RGB') for crop in batch]
+            pixel_values = self.mocr.processor(batch, return_tensors='pt').pixel_values
+
+            with torch.no_grad():
+                output_ids = self.mocr.model.generate(pixel_values.to(self.mocr.model.device), max_length=300).cpu()
+
+            decoded = self.mocr.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+            texts.extend(post_process(text) for text in decoded)
+
+        return texts
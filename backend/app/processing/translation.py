@@ -1,22 +1,80 @@
 from googletrans import Translator as GoogleTranslator
 import google.generativeai as genai
-from openai import OpenAI
+from openai import AsyncOpenAI
+import httpx
 import asyncio
 import os
 import json
 from dotenv import load_dotenv
+from app import config
+from app.processing.translation_memory import TranslationMemory
+from app.utils import metrics
+from app.utils.debug import debug_print
 
 # Load environment variables
 load_dotenv()
 
+
+def provider_max_connections(provider: str) -> int:
+    return config.PROVIDER_MAX_CONNECTIONS.get(provider, config.TRANSLATION_MAX_CONCURRENCY)
+
+
+def provider_timeout(provider: str) -> float:
+    return config.PROVIDER_TIMEOUTS.get(provider, config.PROVIDER_DEFAULT_TIMEOUT)
+
+
+# Pooled keep-alive HTTP client for an OpenAI compatible provider, shared by every request the provider gets
+def make_http_client(provider: str) -> httpx.AsyncClient:
+    max_connections = provider_max_connections(provider)
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=config.PROVIDER_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(provider_timeout(provider)),
+    )
+
+
+# Split the texts into chunks of at most max_lines lines and about max_chars characters, a single longer line gets a chunk of its own
+def make_chunks(texts: list, max_lines: int, max_chars: int) -> list:
+    chunks = []
+    current_chunk = []
+    current_chars = 0
+
+    for text in texts:
+        if current_chunk and (len(current_chunk) >= max_lines or current_chars + len(text) > max_chars):
+            chunks.append(current_chunk)
+            current_chunk = []
+            current_chars = 0
+
+        current_chunk.append(text)
+        current_chars += len(text)
+
+    if current_chunk:
+        chunks.append(current_chunk)
+
+    return chunks
+
+
+# Errors caused by the answer itself, splitting the chunk can get around them. json.JSONDecodeError is a ValueError too
+def is_content_failure(error: Exception) -> bool:
+    return isinstance(error, ValueError)
+
+
 class TextTranslator:
     def __init__(self):
 
-        self.GoogleTranslator = GoogleTranslator()
+        # googletrans is already async (httpx), its list translations are bounded by the same limit as our chunks
+        self.GoogleTranslator = GoogleTranslator(
+            timeout=httpx.Timeout(provider_timeout('google')),
+            list_operation_max_concurrency=provider_max_connections('google'),
+        )
 
         gemini_key = os.getenv("GEMINI_API_KEY")
         if gemini_key:
             genai.configure(api_key=gemini_key)
+            # generate_content_async goes through a single grpc asyncio channel, multiplexed and kept alive by grpc
             self.GeminiTranslator = genai.GenerativeModel("models/gemini-2.0-flash")
         else:
             self.GeminiTranslator = None
@@ -25,41 +83,152 @@ class TextTranslator:
 
         deepseek_key = os.environ.get('DEEPSEEK_API_KEY')
         if deepseek_key:
-            self.DeepseekTranslatorClient = OpenAI(
+            self.DeepseekTranslatorClient = AsyncOpenAI(
                 api_key=deepseek_key, 
-                base_url="https://api.deepseek.com"
+                base_url="https://api.deepseek.com",
+                http_client=make_http_client('deepseek'),
             )
         else:
             self.DeepseekTranslatorClient = None
             print("DeepSeek API Key missing. DeepSeek translation disabled.")
 
+        self.memory = TranslationMemory() if config.TRANSLATION_MEMORY_ENABLED else None
+
+        self.providers = {
+            'gemini': self.gemini_translation,
+            'deepseek': self.deepseek_translation,
+            'google': self.google_translation,
+        }
+        self.semaphores = {}
+
 
 
-    async def translate_batch(self, texts: list, translator_option: str, original_language: str = 'ja', target_language: str='en') -> list:
+    # Lines that could not be translated come back as their original text, or as None with fallback=False so the caller can tell
+    async def translate_batch(self, texts: list, translator_option: str, original_language: str = 'ja', target_language: str='en', fallback: bool = True) -> list:
 
         if not texts:
             return []
 
-        try:
-            if translator_option == 'gemini' and self.GeminiTranslator:
-                return await self.gemini_translation(texts, original_language, target_language)
-            
-            elif translator_option == "deepseek" and self.DeepseekTranslatorClient:
-                return await self.deepseek_translation(texts, original_language, target_language)
+        provider = self.resolve_provider(translator_option)
 
-            else:
-                results = await self.GoogleTranslator.translate(texts, src=original_language, dest=target_language)
-                return [result.text.upper() for result in results]
+        # Lines we already translated with this provider don't need to go out again, SQLite runs off the event loop
+        if self.memory:
+            results = await asyncio.to_thread(self.memory.get_many, provider, original_language, target_language, texts)
+        else:
+            results = [None] * len(texts)
+
+        # Each distinct missing line is only sent once, even if it shows up in several bubbles
+        missing_texts = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+
+        if missing_texts:
+            translations = await self.translate_with_provider(provider, missing_texts, original_language, target_language)
+
+            # Lines whose chunk failed come back as None, only the successful ones go in the memory
+            if self.memory:
+                succeeded = [(text, translation) for text, translation in zip(missing_texts, translations) if translation is not None]
+                if succeeded:
+                    await asyncio.to_thread(self.memory.put_many, provider, original_language, target_language, *zip(*succeeded))
+
+            translated = dict(zip(missing_texts, translations))
+            results = [translated[text] if result is None else result for text, result in zip(texts, results)]
+
+        if fallback:
+            results = [text if result is None else result for text, result in zip(texts, results)] # Return original text if translation failed
+
+        return results
+
+
+    # Add or replace a provider, translate_fn(texts, original_language, target_language) must return a list of the same length or raise
+    # This is also how a local fake provider gets plugged in for testing
+    def register_provider(self, name: str, translate_fn):
+        self.providers[name] = translate_fn
+
+
+    # The provider that will actually be used for this option, anything unavailable falls back to Google
+    def resolve_provider(self, translator_option: str) -> str:
+        if translator_option == 'gemini' and self.GeminiTranslator:
+            return 'gemini'
+        elif translator_option == "deepseek" and self.DeepseekTranslatorClient:
+            return 'deepseek'
+        elif translator_option in self.providers and translator_option not in ('gemini', 'deepseek'):
+            return translator_option
+        return 'google'
+
+
+    # Split the texts into size bounded chunks and translate them concurrently
+    # Returns the translations in the same order, with None for the lines that could not be translated
+    async def translate_with_provider(self, provider: str, texts: list, original_language: str, target_language: str):
+        chunks = make_chunks(texts, config.TRANSLATION_CHUNK_MAX_LINES, config.TRANSLATION_CHUNK_MAX_CHARS)
+
+        if len(chunks) > 1:
+            debug_print(f"[{provider}] Split {len(texts)} lines into {len(chunks)} chunks", flush=True)
+
+        with metrics.TRANSLATION_SECONDS.labels(provider).time():
+            chunk_results = await asyncio.gather(*(
+                self.translate_chunk(provider, chunk, original_language, target_language, config.TRANSLATION_CHUNK_RETRIES)
+                for chunk in chunks
+            ))
+
+        return [translation for chunk_result in chunk_results for translation in chunk_result]
+
+
+    # Translate one chunk, retrying it on its own a few times before splitting it in half, so one bad line never discards the rest
+    # Only content failures (a bad JSON answer, the wrong number of lines) are split, a timeout or a connection error would
+    # just fail again on every half, so after the retries the whole chunk comes back as None
+    async def translate_chunk(self, provider: str, chunk: list, original_language: str, target_language: str, retries: int):
+        for attempt in range(retries + 1):
+            try:
+                # Bounds how many requests are in flight per provider across every request of the server
+                async with self.get_semaphore(provider):
+                    translations = await self.providers[provider](chunk, original_language, target_language)
+
+                if not isinstance(translations, list) or len(translations) != len(chunk):
+                    raise ValueError(f"Batch length mismatch: Expected {len(chunk)}, got {len(translations) if isinstance(translations, list) else translations}")
+
+                return translations
+
+            except Exception as e:
+                content_failure = is_content_failure(e)
+                print(f"[{provider}] Chunk of {len(chunk)} lines failed on attempt {attempt + 1} ({e})", flush=True)
+                if attempt < retries:
+                    await asyncio.sleep(config.TRANSLATION_RETRY_BACKOFF * (2 ** attempt))
+
+        if len(chunk) == 1 or not content_failure:
+            return [None] * len(chunk)
+
+        # The halves are not retried again, a chunk that keeps failing is most likely a content problem and not a network one
+        middle = len(chunk) // 2
+        first_half, second_half = await asyncio.gather(
+            self.translate_chunk(provider, chunk[:middle], original_language, target_language, 0),
+            self.translate_chunk(provider, chunk[middle:], original_language, target_language, 0),
+        )
+        return first_half + second_half
+
+
+    def get_semaphore(self, provider: str):
+        if provider not in self.semaphores:
+            self.semaphores[provider] = asyncio.Semaphore(provider_max_connections(provider))
+        return self.semaphores[provider]
+
+
+    # Close the pooled connections, called when the server shuts down
+    async def aclose(self):
+        if self.DeepseekTranslatorClient:
+            await self.DeepseekTranslatorClient.close()
+
+        google_client = getattr(self.GoogleTranslator, 'client', None)
+        if isinstance(google_client, httpx.AsyncClient):
+            await google_client.aclose()
+
+
+    async def google_translation(self, texts: list, original_language: str, target_language: str):
+        results = await self.GoogleTranslator.translate(texts, src=original_language, dest=target_language)
+        return [result.text.upper() for result in results]
 
-        except Exception as e:
-            print(f"An error occurred during batch translation: {e}")
-            return texts # Return original text if translation failed
-        
 
-        
     async def gemini_translation(self, texts: list, original_language: str, target_language: str):
 
-        print(f"[Gemini] Attempting batch translation for {len(texts)} lines...", flush=True)
+        debug_print(f"[Gemini] Attempting batch translation for {len(texts)} lines...", flush=True)
 
         try:
 
@@ -81,10 +250,10 @@ class TextTranslator:
             ["HELLO", "GOODBYE", "WHERE IS IT?"]
             """
 
-            response = await asyncio.to_thread(
-                self.GeminiTranslator.generate_content,
+            response = await self.GeminiTranslator.generate_content_async(
                 prompt,
-                generation_config={"response_mime_type": "application/json"}
+                generation_config={"response_mime_type": "application/json"},
+                request_options={"timeout": provider_timeout('gemini')}
             )
 
 
@@ -94,18 +263,18 @@ class TextTranslator:
             if not isinstance(translations, list) or len(translations) != len(texts):
                 raise ValueError(f"Batch length mismatch: Expected {len(texts)}, got {len(translations)}")
 
-            print(f"[Gemini] Batch success! Translated {len(translations)} lines.", flush=True)
+            debug_print(f"[Gemini] Batch success! Translated {len(translations)} lines.", flush=True)
             return translations
 
         except Exception as e:
-            print(f"[Gemini] Batch translation failed ({e}). Switching to individual translation...", flush=True)
-            return texts
+            print(f"[Gemini] Batch translation failed ({e}).", flush=True)
+            raise
             # return await self._gemini_fallback(texts)
 
 
     async def deepseek_translation(self, texts: list, original_language: str = 'ja', target_language: str = 'en'):
 
-        print(f"[DeepSeek] Attempting batch translation for {len(texts)} lines...", flush=True)
+        debug_print(f"[DeepSeek] Attempting batch translation for {len(texts)} lines...", flush=True)
 
         try:
 
@@ -128,8 +297,7 @@ class TextTranslator:
             }}
             """
 
-            response = await asyncio.to_thread(
-                self.DeepseekTranslatorClient.chat.completions.create,
+            response = await self.DeepseekTranslatorClient.chat.completions.create(
                 model="deepseek-chat",
                 messages=[
                     {"role": "system", "content": "You are a helpful manga translator that outputs valid JSON."},
@@ -145,11 +313,12 @@ class TextTranslator:
             if not isinstance(translations, list) or len(translations) != len(texts):
                 raise ValueError(f"Batch length mismatch: Expected {len(texts)}, got {len(translations)}")
 
-            print(f"[DeepSeek] Batch success! Translated {len(translations)} lines.", flush=True)
+            debug_print(f"[DeepSeek] Batch success! Translated {len(translations)} lines.", flush=True)
             return translations
 
         except Exception as e:
             print(f"[DeepSeek] Batch failed ({e})", flush=True)
+            raise
 
 
 
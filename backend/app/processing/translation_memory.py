@@ -0,0 +1,98 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from app import config
+from app.utils import metrics
+
+# Lines looked up per query, SQLite limits the number of parameters of a statement
+LOOKUP_CHUNK_SIZE = 500
+
+
+# Same line OCR'd slightly differently (full width characters, extra spaces) should still hit the same entry
+def normalize_text(text):
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+# Persistent cache of source line -> translation, keyed by (provider, source language, target language, normalized text)
+class TranslationMemory:
+    def __init__(self, path=None):
+        self.path = path or config.TRANSLATION_MEMORY_PATH
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS translations (
+                provider TEXT NOT NULL,
+                source_language TEXT NOT NULL,
+                target_language TEXT NOT NULL,
+                source_text TEXT NOT NULL,
+                translated_text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (provider, source_language, target_language, source_text)
+            )
+        ''')
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the translation of every text, None for the ones that are not in the memory
+    # Blocking, every distinct line is looked up in a few IN (...) queries instead of one query per line
+    def get_many(self, provider, source_language, target_language, texts):
+        normalized_texts = [normalize_text(text) for text in texts]
+        distinct_texts = list(dict.fromkeys(normalized_texts))
+
+        found = {}
+        with self.lock:
+            for start in range(0, len(distinct_texts), LOOKUP_CHUNK_SIZE):
+                chunk = distinct_texts[start:start + LOOKUP_CHUNK_SIZE]
+                rows = self.db.execute(
+                    f'SELECT source_text, translated_text FROM translations WHERE provider = ? AND source_language = ? AND target_language = ? AND source_text IN ({", ".join("?" * len(chunk))})',
+                    (provider, source_language, target_language, *chunk)
+                ).fetchall()
+                found.update(rows)
+
+            results = [found.get(text) for text in normalized_texts]
+            hits = sum(1 for result in results if result is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        metrics.TRANSLATION_MEMORY_LOOKUPS.labels('hit').inc(hits)
+        metrics.TRANSLATION_MEMORY_LOOKUPS.labels('miss').inc(len(results) - hits)
+        return results
+
+    # Blocking, a single commit for all the lines
+    def put_many(self, provider, source_language, target_language, texts, translations):
+        now = time.time()
+        rows = [
+            (provider, source_language, target_language, normalize_text(text), translation, now)
+            for text, translation in zip(texts, translations)
+        ]
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO translations (provider, source_language, target_language, source_text, translated_text, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
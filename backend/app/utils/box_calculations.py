@@ -1,3 +1,6 @@
+import math
+import numpy as np
+
 def box_area(box):
     x1, y1, x2, y2 = box
     return max(0.0, x2 - x1) * max(0.0, y2 - y1)
@@ -39,6 +42,67 @@ def enlarge_box(box, max_width, max_height, enlarge_factor=0.1):
 
     return [new_x1, new_y1, new_x2, new_y2]
 
+def boxes_gap(boxA, boxB):
+    # Distance between the closest edges of two boxes, 0 if they overlap
+    ax1, ay1, ax2, ay2 = boxA
+    bx1, by1, bx2, by2 = boxB
+
+    gap_x = max(0, max(ax1, bx1) - min(ax2, bx2))
+    gap_y = max(0, max(ay1, by1) - min(ay2, by2))
+
+    return max(gap_x, gap_y)
+
+# Whether box is entirely inside region, the parts of box outside the page (max_width, max_height) don't count
+def box_inside(box, region, max_width, max_height):
+    x1, y1, x2, y2 = box
+    rx1, ry1, rx2, ry2 = region
+
+    return rx1 <= max(0, x1) and ry1 <= max(0, y1) and min(max_width, x2) <= rx2 and min(max_height, y2) <= ry2
+
+# Expand every box by a margin and merge the ones that are close to each other into bigger tiles (integer pixel coordinates)
+# Tiles can overlap, but only a single box bigger than max_tile_size makes a tile bigger than that
+def merge_into_regions(boxes, max_width, max_height, margin=64, merge_distance=32, max_tile_size=1024):
+    regions = []
+    for box in boxes:
+        if not box:
+            continue
+        x1, y1, x2, y2 = box
+        regions.append([
+            max(0, math.floor(x1) - margin),
+            max(0, math.floor(y1) - margin),
+            min(max_width, math.ceil(x2) + margin),
+            min(max_height, math.ceil(y2) + margin),
+        ])
+
+    # Keep merging until no two regions are close enough, a merge can bring a region closer to another one
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                if boxes_gap(regions[i], regions[j]) > merge_distance:
+                    continue
+
+                union = [
+                    min(regions[i][0], regions[j][0]),
+                    min(regions[i][1], regions[j][1]),
+                    max(regions[i][2], regions[j][2]),
+                    max(regions[i][3], regions[j][3]),
+                ]
+
+                # Do not let a tile grow past the max size, even when the two overlap they stay separate tiles
+                if union[2] - union[0] > max_tile_size or union[3] - union[1] > max_tile_size:
+                    continue
+
+                regions[i] = union
+                del regions[j]
+                merged = True
+                break
+            if merged:
+                break
+
+    return regions
+
 # Return how many percentage of these two bounding boxes are overlapping
 def iou(boxA, boxB):
 	ax1, ay1, ax2, ay2 = boxA
@@ -61,40 +125,122 @@ def iou(boxA, boxB):
 
 	return intersection_area / union
 
-# Find and group the bubble and text_bubble by their iou score and return them as a group of clusters
-def group_by_iou(detections, iou_threshold=0.3):
+# Pairwise IoU between boxes_a (..., N, 4) and boxes_b (..., M, 4) as a single numpy operation, returns a (..., N, M) matrix
+# Leading dimensions are broadcasted, so a stack of pages (P, N, 4) gives one (P, N, M) matrix per page
+def pairwise_iou(boxes_a, boxes_b):
+    a = np.asarray(boxes_a, dtype=np.float64)[..., :, None, :]
+    b = np.asarray(boxes_b, dtype=np.float64)[..., None, :, :]
 
-    if not detections:
-        return {}
+    left = np.maximum(a[..., 0], b[..., 0])
+    right = np.minimum(a[..., 2], b[..., 2])
+    top = np.maximum(a[..., 1], b[..., 1])
+    bottom = np.minimum(a[..., 3], b[..., 3])
+
+    intersection_area = np.maximum(0, right - left) * np.maximum(0, bottom - top)
+
+    area_a = np.maximum(0.0, a[..., 2] - a[..., 0]) * np.maximum(0.0, a[..., 3] - a[..., 1])
+    area_b = np.maximum(0.0, b[..., 2] - b[..., 0]) * np.maximum(0.0, b[..., 3] - b[..., 1])
+
+    union = area_a + area_b - intersection_area
+
+    # Avoid dividing by 0, those pairs get an iou of 0 like the scalar version
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(union == 0, 0.0, intersection_area / union)
+
+    return result
+
+# Greedy assignment of the clusters from a precomputed iou matrix between the seeds (anything but text_bubble) and the candidates (anything but bubble)
+def assign_clusters(labels, boxes, seed_indexes, candidate_indexes, iou_matrix, iou_threshold=0.3):
+    # Every (seed, candidate) pair above the threshold, grouped by seed row and kept in candidate order
+    rows, cols = np.nonzero(np.asarray(iou_matrix) >= iou_threshold)
+    matches_per_seed = np.split(candidate_indexes[cols], np.searchsorted(rows, np.arange(1, len(seed_indexes))))
+
+    box_lists = boxes.tolist()
+    candidates = set(candidate_indexes.tolist())
+    remaining_candidates = len(candidates)
 
-    # indexes = sorted(range(len(detections)), key=lambda i: detections[i][1], reverse=True)
     used = set()
     clusters = {}
 
-    for index, bubble_index in enumerate(detections):
-        if bubble_index in used or detections[bubble_index]['label'] == 'text_bubble':
+    for seed, matches in zip(seed_indexes.tolist(), matches_per_seed):
+        if seed in used:
             continue
+        used.add(seed)
+        if seed in candidates:
+            remaining_candidates -= 1
 
-        cluster = {
-        detections[bubble_index]['label']: detections[bubble_index]['coordinates']
-        }
+        # A seed only becomes a cluster if there was at least one candidate left to compare it with
+        if remaining_candidates == 0:
+            continue
 
-        used.add(bubble_index)
+        cluster = {labels[seed]: box_lists[seed]}
 
-        for text_bubble_index in detections:
-            if text_bubble_index in used or detections[text_bubble_index]['label'] == 'bubble':
+        for match in matches.tolist():
+            if match in used:
                 continue
-            coordinatesA = detections[bubble_index]['coordinates']
-            coordinatesB = detections[text_bubble_index]['coordinates']
+            cluster[labels[match]] = box_lists[match]
+            used.add(match)
+            remaining_candidates -= 1
 
-            if iou(coordinatesA, coordinatesB) >= iou_threshold:
-                cluster[detections[text_bubble_index]['label']] = detections[text_bubble_index]['coordinates']
-                used.add(text_bubble_index)
+        clusters[seed] = cluster
 
-            clusters[index] = cluster
-            
     return clusters
 
+def split_seeds_and_candidates(labels):
+    seed_indexes = np.array([i for i, label in enumerate(labels) if label != 'text_bubble'], dtype=np.intp)
+    candidate_indexes = np.array([i for i, label in enumerate(labels) if label != 'bubble'], dtype=np.intp)
+    return seed_indexes, candidate_indexes
+
+# Find and group the bubble and text_bubble by their iou score and return them as a group of clusters
+def group_by_iou(detections, iou_threshold=0.3):
+
+    if not detections:
+        return {}
+
+    keys = list(detections)
+    labels = [detections[key]['label'] for key in keys]
+    boxes = np.asarray([detections[key]['coordinates'] for key in keys], dtype=np.float64).reshape(-1, 4)
+
+    seed_indexes, candidate_indexes = split_seeds_and_candidates(labels)
+    iou_matrix = pairwise_iou(boxes[seed_indexes], boxes[candidate_indexes])
+
+    # Clusters are keyed by the position of their seed in the detections
+    return assign_clusters(labels, boxes, seed_indexes, candidate_indexes, iou_matrix, iou_threshold)
+
+def to_numpy(values):
+    if hasattr(values, 'detach'):
+        values = values.detach().cpu().numpy()
+    return np.asarray(values)
+
+# Same grouping as group_by_iou but for every page at once, directly on the tensors BubbleDetector.detect returns
+# Returns a list with the clusters of each page
+def group_detections_batch(all_raw_results, label_map, iou_threshold=0.3):
+    if not all_raw_results:
+        return []
+
+    all_boxes = [to_numpy(result['boxes']).astype(np.float64).reshape(-1, 4) for result in all_raw_results]
+    all_labels = [[label_map.get(label) for label in to_numpy(result['labels']).reshape(-1).tolist()] for result in all_raw_results]
+
+    all_seeds, all_candidates = zip(*(split_seeds_and_candidates(labels) for labels in all_labels))
+
+    # Pad the seeds and candidates of every page to the same count so all the iou matrices come out of one operation
+    max_seeds = max(len(seeds) for seeds in all_seeds)
+    max_candidates = max(len(candidates) for candidates in all_candidates)
+    padded_seeds = np.zeros((len(all_boxes), max_seeds, 4), dtype=np.float64)
+    padded_candidates = np.zeros((len(all_boxes), max_candidates, 4), dtype=np.float64)
+    for page_index, (boxes, seeds, candidates) in enumerate(zip(all_boxes, all_seeds, all_candidates)):
+        padded_seeds[page_index, :len(seeds)] = boxes[seeds]
+        padded_candidates[page_index, :len(candidates)] = boxes[candidates]
+
+    iou_matrices = pairwise_iou(padded_seeds, padded_candidates)
+
+    all_clusters = []
+    for page_index, (boxes, labels, seeds, candidates) in enumerate(zip(all_boxes, all_labels, all_seeds, all_candidates)):
+        iou_matrix = iou_matrices[page_index, :len(seeds), :len(candidates)]
+        all_clusters.append(assign_clusters(labels, boxes, seeds, candidates, iou_matrix, iou_threshold))
+
+    return all_clusters
+
 """
 def adjust_box_height(orig_smaller_box, ref_of_larger_box, min_height_threshold=50, height_increase_factor=0.3):
 
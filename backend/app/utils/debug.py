@@ -0,0 +1,50 @@
+import contextvars
+import itertools
+import os
+import uuid
+from contextlib import contextmanager
+from app import config
+
+# Folder the debug images of the current request go to, None when the request is not being debugged
+current_debug_dir = contextvars.ContextVar('current_debug_dir', default=None)
+
+request_counter = itertools.count()
+
+
+def is_debug_mode():
+    return config.APP_MODE == 'debug'
+
+
+# Verbose logs, only printed in debug mode
+def debug_print(*args, **kwargs):
+    if is_debug_mode():
+        print(*args, **kwargs)
+
+
+# Every request is debugged in debug mode, 1 in DEBUG_SAMPLE_RATE requests in production
+def should_debug_request():
+    if is_debug_mode():
+        return True
+    return config.DEBUG_SAMPLE_RATE > 0 and next(request_counter) % config.DEBUG_SAMPLE_RATE == 0
+
+
+# The debug images of everything inside the block go to a folder of their own, so concurrent requests never overwrite each other
+# Yields that folder, or None when this request is not sampled
+@contextmanager
+def debug_request(name=None):
+    if not should_debug_request():
+        yield None
+        return
+
+    path = os.path.join(config.DEBUG_OUTPUT_DIR, name or uuid.uuid4().hex)
+    os.makedirs(path, exist_ok=True)
+
+    token = current_debug_dir.set(path)
+    try:
+        yield path
+    finally:
+        current_debug_dir.reset(token)
+
+
+def debug_dir():
+    return current_debug_dir.get()
@@ -0,0 +1,84 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Latency buckets in seconds, from a single OCR crop up to a slow translation provider
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram('manga_stage_seconds', 'Time spent in each pipeline stage', ['stage'], buckets=LATENCY_BUCKETS)
+OCR_BATCH_SECONDS = Histogram('manga_ocr_batch_seconds', 'Time of one OCR call on the bubble crops of a group of pages', buckets=LATENCY_BUCKETS)
+OCR_BATCH_CROPS = Histogram('manga_ocr_batch_crops', 'Bubble crops in one OCR call', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+DRAW_TEXT_SECONDS = Histogram('manga_draw_text_seconds', 'Time to fit and draw the translated text of one bubble', buckets=LATENCY_BUCKETS)
+TRANSLATION_SECONDS = Histogram('manga_translation_seconds', 'Time of a translate_batch call by provider', ['provider'], buckets=LATENCY_BUCKETS)
+TRANSLATION_MEMORY_LOOKUPS = Counter('manga_translation_memory_lookups_total', 'Lines looked up in the translation memory', ['result'])
+PAGES = Counter('manga_pages_total', 'Pages that went through the pipeline', ['status'])
+BUBBLES = Counter('manga_bubbles_total', 'Bubbles detected')
+PAGES_IN_FLIGHT = Gauge('manga_pages_in_flight', 'Pages currently inside the page scheduler')
+DETECTION_BATCH_SIZE = Histogram('manga_detection_batch_size', 'Pages in one forward pass of the detector', buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+DETECTION_QUEUE_WAIT_SECONDS = Histogram('manga_detection_queue_wait_seconds', 'Time a page waited in the detection batcher before its batch started', buckets=LATENCY_BUCKETS)
+QUEUE_DEPTH = Gauge('manga_queue_depth', 'Items waiting in a queue', ['queue'])
+MODEL_MEMORY = Gauge('manga_model_memory_bytes', 'Memory taken by the weights of each model', ['model'])
+MODEL_LOAD_SECONDS = Gauge('manga_model_load_seconds', 'Time it took to load (and warm up) each model', ['model'])
+
+
+# Time spent per stage by one request, filled from the event loop and the model threads
+class StageTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.seconds)
+
+    # Server-Timing header value, durations in milliseconds
+    def server_timing(self):
+        return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in self.to_dict().items())
+
+
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+# Everything timed inside the block is also added to timings
+@contextmanager
+def collect_timings(timings):
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+def record(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+# Size of the weights of a torch model, 0 when it doesn't expose them
+def model_size_bytes(model):
+    try:
+        return sum(tensor.numel() * tensor.element_size() for tensor in list(model.parameters()) + list(model.buffers()))
+    except Exception:
+        return 0
+
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,61 +1,96 @@
 from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
 import textwrap
+from app import config
 
-def draw_text_in_box(draw, box, text, font_path, initial_font_size=30):
-    x1, y1, x2, y2 = box
-    font_size = initial_font_size
-    font = None
+# Loaded fonts are shared by the whole process, so a font file is only read once per size
+@lru_cache(maxsize=config.FONT_CACHE_SIZE)
+def get_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
 
-    box_width = x2 - x1
-    box_height = y2 - y1
+# Width of a single line of text, the same line gets measured again for every bubble and every font size we try
+@lru_cache(maxsize=config.TEXT_MEASURE_CACHE_SIZE)
+def measure_line(font_path, font_size, line):
+    return get_font(font_path, font_size).getbbox(line)
+
+def wrap_words(words, font_path, font_size, box_width):
+    lines = []
+    current_line = words[0]
+
+    for word in words[1:]:
+        # check the width of the line if we add the next word
+        if measure_line(font_path, font_size, current_line + " " + word)[2] <= box_width:
+            current_line += " " + word
+        else:
+            lines.append(current_line)
+            current_line = word
+
+    lines.append(current_line)
+    return "\n".join(lines)
 
-    wrapped_text = ''
+# Text blocks are measured on this instead of the image being drawn on, the bbox only depends on the font and the font mode
+@lru_cache(maxsize=None)
+def get_measure_draw(fontmode):
+    draw = ImageDraw.Draw(Image.new('L', (1, 1)))
+    draw.fontmode = fontmode
+    return draw
 
-    while font_size > 0:
-        font = ImageFont.truetype(font_path, font_size)
+# Wrap the text with the given font size and return it with its bbox if it fits in the box, None otherwise
+def fit_text(words, font_path, font_size, box_width, box_height, fontmode):
 
-        lines = []
-        words = text.split()
-        if not words:
-            break
+    # Every word ends up on a line of its own or with others, so the text block is always at least as wide as its widest word
+    # If one word is already too wide, this size can't fit and there is no need to wrap and measure the whole block
+    for word in words:
+        left, _, right, _ = measure_line(font_path, font_size, word)
+        if right - left > box_width:
+            return None
 
-        current_line = words[0]
+    font = get_font(font_path, font_size)
+    wrapped_text = wrap_words(words, font_path, font_size, box_width)
 
-        for word in words[1:]:
-            # check the width of the line if we add the next word
-            if font.getbbox(current_line + " " + word)[2] <= box_width:
-                current_line += " " + word
-            else:
-                lines.append(current_line)
-                current_line = word
+    # Get the height and width of the text block with the current font size
+    text_bbox = get_measure_draw(fontmode).multiline_textbbox((0, 0), wrapped_text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
 
-        lines.append(current_line)
-        wrapped_text = "\n".join(lines)
+    if text_width <= box_width and text_height <= box_height:
+        return font_size, wrapped_text, text_bbox
+    return None
 
-        # Get the height and width of the text block with the current font size
-        text_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font)
-        x1, y1, x2, y2 = text_bbox[0], text_bbox[1], text_bbox[2], text_bbox[3]
-        
-        text_width = x2 - x1
-        text_height = y2 - y1
+# Find the biggest font size the text fits in the box with, going down from the initial size
+# This can't be a binary search: with greedy wrapping a size can fit while a smaller one doesn't
+# The result is cached since the same bubble gets laid out again (e.g. by the debug render)
+@lru_cache(maxsize=config.TEXT_LAYOUT_CACHE_SIZE)
+def layout_text(font_path, text, box_width, box_height, initial_font_size=30, fontmode='L'):
+    words = text.split()
+    if not words:
+        return None
 
-        # If it fits, break the loop
-        if text_width <= box_width and text_height <= box_height:
-            break
+    for font_size in range(initial_font_size, 0, -1):
+        fit = fit_text(words, font_path, font_size, box_width, box_height, fontmode)
+        if fit:
+            return fit
+
+    return None
+
+def draw_text_in_box(draw, box, text, font_path, initial_font_size=30):
+    x1, y1, x2, y2 = box
+
+    box_width = x2 - x1
+    box_height = y2 - y1
 
-        # Decreasing the font size otherwise
-        font_size -= 1
+    layout = layout_text(font_path, text, box_width, box_height, initial_font_size, draw.fontmode)
 
     # Draw the text on the image
-    if font_size > 0:
-        text_width = text_bbox[2] - text_bbox[0]
+    if layout:
+        font_size, wrapped_text, final_bbox = layout
+        font = get_font(font_path, font_size)
 
-        # Calculate and get the final dimensions of the text block
-        final_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font)
+        # Final dimensions of the text block
         text_width = final_bbox[2] - final_bbox[0]
         text_height = final_bbox[3] - final_bbox[1]
 
         # Calculated the centered position to draw the text
         text_x = box[0] + (box_width - text_width) / 2
         text_y = box[1] + (box_height - text_height) / 2
-        draw.multiline_text((text_x, text_y), wrapped_text, font=font, fill='black', align='center')
\ No newline at end of file
+        draw.multiline_text((text_x, text_y), wrapped_text, font=font, fill='black', align='center')
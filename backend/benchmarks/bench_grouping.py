@@ -0,0 +1,127 @@
+# Micro-benchmark of the bubble grouping: the previous pure Python group_by_iou against the vectorized one
+# Run from the backend directory: python -m benchmarks.bench_grouping
+import argparse
+import random
+import time
+import numpy as np
+
+from app.utils.box_calculations import iou, group_by_iou, group_detections_batch
+
+BUBBLE_MAP = {0: "bubble", 1: "text_bubble", 2: "text_free"}
+
+
+# The nested loop implementation group_by_iou used before it was vectorized, kept here as the reference
+def group_by_iou_reference(detections, iou_threshold=0.3):
+
+    if not detections:
+        return {}
+
+    used = set()
+    clusters = {}
+
+    for index, bubble_index in enumerate(detections):
+        if bubble_index in used or detections[bubble_index]['label'] == 'text_bubble':
+            continue
+
+        cluster = {
+        detections[bubble_index]['label']: detections[bubble_index]['coordinates']
+        }
+
+        used.add(bubble_index)
+
+        for text_bubble_index in detections:
+            if text_bubble_index in used or detections[text_bubble_index]['label'] == 'bubble':
+                continue
+            coordinatesA = detections[bubble_index]['coordinates']
+            coordinatesB = detections[text_bubble_index]['coordinates']
+
+            if iou(coordinatesA, coordinatesB) >= iou_threshold:
+                cluster[detections[text_bubble_index]['label']] = detections[text_bubble_index]['coordinates']
+                used.add(text_bubble_index)
+
+            clusters[index] = cluster
+
+    return clusters
+
+
+# Random page shaped like the detector output: bubbles with a text box inside most of them, plus some free text
+def make_page(rng, num_bubbles, width=2000, height=3000):
+    boxes, labels = [], []
+    for _ in range(num_bubbles):
+        w, h = rng.uniform(80, 400), rng.uniform(80, 500)
+        x1, y1 = rng.uniform(0, width - w), rng.uniform(0, height - h)
+        boxes.append([x1, y1, x1 + w, y1 + h])
+        labels.append(0)
+
+        if rng.random() < 0.9:
+            shrink_w, shrink_h = w * rng.uniform(0.05, 0.25), h * rng.uniform(0.05, 0.25)
+            boxes.append([x1 + shrink_w, y1 + shrink_h, x1 + w - shrink_w, y1 + h - shrink_h])
+            labels.append(1)
+
+        if rng.random() < 0.3:
+            fw, fh = rng.uniform(30, 200), rng.uniform(30, 200)
+            fx, fy = rng.uniform(0, width - fw), rng.uniform(0, height - fh)
+            boxes.append([fx, fy, fx + fw, fy + fh])
+            labels.append(2)
+
+    # The detector returns boxes sorted by score, not grouped by bubble
+    order = list(range(len(boxes)))
+    rng.shuffle(order)
+
+    return {
+        'boxes': np.asarray([boxes[i] for i in order], dtype=np.float32).reshape(-1, 4),
+        'labels': np.asarray([labels[i] for i in order], dtype=np.int64),
+    }
+
+
+def to_detections(raw_result):
+    return {
+        box_index: {
+            'label': BUBBLE_MAP.get(int(label)),
+            'coordinates': [float(c) for c in coord],
+        }
+        for box_index, (label, coord) in enumerate(zip(raw_result['labels'], raw_result['boxes']))
+    }
+
+
+def time_it(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--bubbles', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    print(f"{'bubbles/page':>12} {'reference':>12} {'vectorized':>12} {'batched':>12} {'speedup':>8}")
+    for num_bubbles in args.bubbles:
+        raw_results = [make_page(rng, num_bubbles) for _ in range(args.pages)]
+
+        # Building the detections dict is part of what the batched variant saves, so it is timed with the per page versions
+        reference = lambda: [group_by_iou_reference(to_detections(r), 0.3) for r in raw_results]
+        vectorized = lambda: [group_by_iou(to_detections(r), 0.3) for r in raw_results]
+        batched = lambda: group_detections_batch(raw_results, BUBBLE_MAP, 0.3)
+
+        expected = reference()
+        assert vectorized() == expected, "group_by_iou does not match the reference implementation"
+        assert batched() == expected, "group_detections_batch does not match the reference implementation"
+
+        reference_time = time_it(reference, args.repeats)
+        vectorized_time = time_it(vectorized, args.repeats)
+        batched_time = time_it(batched, args.repeats)
+
+        print(f"{num_bubbles:>12} {reference_time * 1000:>10.2f}ms {vectorized_time * 1000:>10.2f}ms {batched_time * 1000:>10.2f}ms {reference_time / batched_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
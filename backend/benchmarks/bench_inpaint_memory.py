@@ -0,0 +1,96 @@
+# Peak RSS and time of one InPainter.inpaint call per page size: the previous numpy float conversion against the buffered one
+# Every measurement runs in a fresh process since the peak RSS of a process never goes back down
+# The identity model isolates the cost of the conversions, --model lama also runs the real model
+# Run from the backend directory: python -m benchmarks.bench_inpaint_memory
+import argparse
+import multiprocessing
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+
+from benchmarks.fakes import IdentityModel
+from benchmarks.run import peak_rss_mb
+from benchmarks.synthetic import PAGE_SIZES
+
+
+# The conversions InPainter.inpaint did before the buffered path, kept here as the reference
+def inpaint_reference(model, image, mask):
+    import torch
+    from app import config
+
+    img_np = np.array(image).astype('float32') / 255.0
+    mask_np = np.array(mask).astype('float') / 255.0
+    mask_np = (mask_np > 0.5).astype('float32')
+
+    img_tensor = torch.from_numpy(img_np).permute(2, 0, 1).unsqueeze(0).to(config.DEVICE)
+    mask_tensor = torch.from_numpy(mask_np).unsqueeze(0).unsqueeze(0).to(config.DEVICE)
+
+    with torch.no_grad():
+        output = model(img_tensor, mask_tensor)
+
+    res_img = output[0].permute(1, 2, 0).detach().cpu().numpy()
+    res_img = np.clip(res_img * 255, 0, 255).astype("uint8")
+
+    return Image.fromarray(res_img)
+
+
+def make_inputs(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+    mask = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    for _ in range(20):
+        x, y = int(rng.integers(0, width - 200)), int(rng.integers(0, height - 200))
+        draw.rectangle([x, y, x + 200, y + 120], fill='white')
+
+    return image, mask
+
+
+def measure(path, model_name, width, height):
+    from app.processing.inpainting import InPainter
+
+    model = IdentityModel() if model_name == 'identity' else None
+    inpainter = InPainter(model=model)
+    image, mask = make_inputs(width, height)
+
+    # Loading the model and building the inputs are not part of the measurement
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+
+    if path == 'reference':
+        result = inpaint_reference(inpainter.model, image, mask)
+    else:
+        result = inpainter.inpaint(image, mask)
+
+    elapsed = time.perf_counter() - start
+    return peak_rss_mb() - baseline, elapsed, np.asarray(result).tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', choices=list(PAGE_SIZES), default=['a4', 'spread', '4k-spread'])
+    parser.add_argument('--model', choices=['identity', 'lama'], default='identity')
+    args = parser.parse_args()
+
+    from app import config
+
+    context = multiprocessing.get_context('spawn')
+
+    print(f"{'size':>10} {'pixels':>10} {'reference':>22} {'buffered':>22}")
+    for size_name in args.sizes:
+        # The same pages as the other benchmarks, cropped to what LaMa accepts
+        width, height = (side // config.INPAINT_STRIDE * config.INPAINT_STRIDE for side in PAGE_SIZES[size_name])
+        row = {}
+        for path in ('reference', 'buffered'):
+            with context.Pool(1) as pool:
+                row[path] = pool.apply(measure, (path, args.model, width, height))
+
+        assert row['reference'][2] == row['buffered'][2], "buffered conversion does not match the reference"
+
+        cells = [f"{row[path][0]:>8.1f}MB {row[path][1] * 1000:>8.1f}ms" for path in ('reference', 'buffered')]
+        print(f"{size_name:>10} {width * height / 1e6:>9.1f}M {cells[0]:>22} {cells[1]:>22}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# Latency and output quality of every inference backend of the detector, OCR and inpainter, compared with eager PyTorch
+# Each (model, backend) pair is loaded and warmed up in a fresh process, so its peak RSS and compilation caches are its own
+# Quality is measured against the eager outputs on the same synthetic inputs: matching boxes for the detector, character error rate for OCR, PSNR for the inpainter
+# Run from the backend directory: python -m benchmarks.compare_backends [--models detector ocr inpainter] [--backends eager int8 compiled onnx]
+import argparse
+import math
+import multiprocessing
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+
+from benchmarks.run import peak_rss_mb, run_metadata, summarize, write_results
+from benchmarks.synthetic import PAGE_SIZES
+
+SUPPORTED_BACKENDS = {
+    'detector': ['eager', 'int8', 'compiled', 'onnx'],
+    'ocr': ['eager', 'int8', 'compiled'],
+    'inpainter': ['eager', 'compiled'],
+}
+
+
+def round_up(value, multiple):
+    return int(math.ceil(value / multiple) * multiple)
+
+
+# Tile of the page around a text box like the region inpainting sends to LaMa, with the text box as the mask
+def text_tile(page, text_box):
+    from app import config
+
+    margin, stride = config.INPAINT_REGION_MARGIN, config.INPAINT_STRIDE
+    x1, y1, x2, y2 = text_box
+
+    width = min(round_up(x2 - x1 + 2 * margin, stride), page.width // stride * stride)
+    height = min(round_up(y2 - y1 + 2 * margin, stride), page.height // stride * stride)
+    left = min(max(0, x1 - margin), page.width - width)
+    top = min(max(0, y1 - margin), page.height - height)
+
+    tile = page.crop((left, top, left + width, top + height))
+    mask = Image.new('L', tile.size, 0)
+    ImageDraw.Draw(mask).rectangle([x1 - left, y1 - top, x2 - left, y2 - top], fill=255)
+    return tile, mask
+
+
+# Inputs of one call of each model: a page for the detector, a batch of text crops for OCR, a tile and its mask for the inpainter
+def make_inputs(model_name, args):
+    from app import config
+    from benchmarks.synthetic import make_pages
+
+    pages = make_pages(args.seed, args.pages, args.size)
+    if model_name == 'detector':
+        return pages
+
+    text_boxes = [(page, text_box) for page in pages for _, text_box in page.info['synthetic_boxes']]
+    if model_name == 'ocr':
+        crops = [page.crop(text_box) for page, text_box in text_boxes]
+        return [crops[start:start + config.OCR_BATCH_SIZE] for start in range(0, len(crops), config.OCR_BATCH_SIZE)]
+
+    return [text_tile(page, text_box) for page, text_box in text_boxes[:args.tiles]]
+
+
+def run_detector(detector, page):
+    result = detector.detect([page])[0]
+    return {key: value.detach().cpu().numpy() for key, value in result.items()}
+
+
+def run_ocr(ocr, crops):
+    return ocr.extract_text_batch(crops)
+
+
+def run_inpainter(inpainter, tile_and_mask):
+    return np.asarray(inpainter.inpaint(*tile_and_mask))
+
+
+MODEL_RUNNERS = {
+    'detector': run_detector,
+    'ocr': run_ocr,
+    'inpainter': run_inpainter,
+}
+
+
+# Runs in its own process, loads the model with the backend through the same code as the server
+def run_backend(model_name, backend, args):
+    from app import config
+    from app.core.model_loader import MODEL_LOADERS
+
+    config.INFERENCE_BACKENDS = {**config.INFERENCE_BACKENDS, model_name: backend}
+    load_fn, warm_up_fn = MODEL_LOADERS[model_name]
+
+    start = time.perf_counter()
+    model = load_fn()
+    warm_up_fn(model)
+    load_seconds = time.perf_counter() - start
+
+    inputs = make_inputs(model_name, args)
+    samples, outputs = [], []
+    for _ in range(args.repeats):
+        outputs = []
+        for item in inputs:
+            call_start = time.perf_counter()
+            outputs.append(MODEL_RUNNERS[model_name](model, item))
+            samples.append(time.perf_counter() - call_start)
+
+    return {
+        'backend': model.backend,
+        'loadSeconds': load_seconds,
+        'calls': len(samples),
+        'latency': summarize(samples),
+        'peakRssMb': peak_rss_mb(),
+        'outputs': outputs,
+    }
+
+
+def box_iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas = (box[2] - box[0]) * (box[3] - box[1]) + (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(areas - intersection, 1e-9)
+
+
+# Share of the eager boxes found again (same label, IoU >= 0.5), share of the backend boxes that match one, and their mean IoU
+def detector_quality(reference_outputs, outputs):
+    matched_ious, reference_count, count = [], 0, 0
+
+    for reference, result in zip(reference_outputs, outputs):
+        reference_count += len(reference['boxes'])
+        count += len(result['boxes'])
+        available = np.ones(len(result['boxes']), dtype=bool)
+
+        for box, label in zip(reference['boxes'], reference['labels']):
+            candidates = available & (result['labels'] == label)
+            if not candidates.any():
+                continue
+            ious = np.where(candidates, box_iou(box, result['boxes']), 0.0)
+            best = int(ious.argmax())
+            if ious[best] >= 0.5:
+                available[best] = False
+                matched_ious.append(float(ious[best]))
+
+    return {
+        'boxRecall': len(matched_ious) / reference_count if reference_count else 1.0,
+        'boxPrecision': len(matched_ious) / count if count else 1.0,
+        'meanIoU': float(np.mean(matched_ious)) if matched_ious else None,
+    }
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def ocr_quality(reference_outputs, outputs):
+    reference_texts = [text for batch in reference_outputs for text in batch]
+    texts = [text for batch in outputs for text in batch]
+
+    distance = sum(edit_distance(reference, text) for reference, text in zip(reference_texts, texts))
+    characters = sum(len(reference) for reference in reference_texts)
+    return {
+        'exactMatch': sum(reference == text for reference, text in zip(reference_texts, texts)) / max(1, len(texts)),
+        'charErrorRate': distance / max(1, characters),
+    }
+
+
+# None when the outputs are identical
+def psnr(mse):
+    return 10 * math.log10(255 ** 2 / mse) if mse > 0 else None
+
+
+def inpainter_quality(reference_outputs, outputs):
+    mses, differences = [], []
+    for reference, result in zip(reference_outputs, outputs):
+        difference = reference.astype(np.float32) - result.astype(np.float32)
+        mses.append(float(np.mean(difference ** 2)))
+        differences.append(float(np.mean(np.abs(difference))))
+
+    return {
+        'psnr': psnr(float(np.mean(mses))),
+        'worstTilePsnr': psnr(max(mses)),
+        'meanAbsDiff': float(np.mean(differences)),
+    }
+
+
+QUALITY_METRICS = {
+    'detector': detector_quality,
+    'ocr': ocr_quality,
+    'inpainter': inpainter_quality,
+}
+
+
+def print_report(results):
+    for model_name, backends in results['models'].items():
+        print(f"\n{model_name}")
+        print(f"{'backend':>10} {'load (s)':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'speedup':>8} {'peak RSS':>10}  quality vs eager")
+        eager_p50 = backends.get('eager', {}).get('latency', {}).get('p50')
+
+        for backend, result in backends.items():
+            if 'error' in result:
+                print(f"{backend:>10}  failed: {result['error']}")
+                continue
+
+            latency = result['latency']
+            speedup = f"{eager_p50 / latency['p50']:.2f}x" if eager_p50 else '-'
+            quality = ', '.join(
+                f"{name} {value:.4f}" if isinstance(value, float) else f"{name} {value}"
+                for name, value in result.get('quality', {}).items()
+            )
+            print(f"{backend:>10} {result['loadSeconds']:>9.1f} {latency['p50'] * 1000:>9.1f} {latency['p95'] * 1000:>9.1f} {speedup:>8} {result['peakRssMb']:>8.1f}MB  {quality}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--models', nargs='+', choices=list(SUPPORTED_BACKENDS), default=list(SUPPORTED_BACKENDS))
+    parser.add_argument('--backends', nargs='+', choices=['eager', 'int8', 'compiled', 'onnx'], default=['eager', 'int8', 'compiled', 'onnx'])
+    parser.add_argument('--pages', type=int, default=8)
+    parser.add_argument('--size', choices=list(PAGE_SIZES), default='a4')
+    parser.add_argument('--tiles', type=int, default=32, help="Text tiles the inpainter is measured on")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file to write, benchmarks/results/backends-<timestamp>.json by default")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {'meta': run_metadata(args), 'models': {}}
+
+    for model_name in args.models:
+        # Eager always runs first, the other backends are compared with its outputs
+        backends = ['eager'] + [backend for backend in args.backends if backend != 'eager' and backend in SUPPORTED_BACKENDS[model_name]]
+        model_results = results['models'][model_name] = {}
+        reference_outputs = None
+
+        for backend in backends:
+            print(f"[compare_backends] {model_name} / {backend}", flush=True)
+            try:
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_backend, (model_name, backend, args))
+            except Exception as e:
+                model_results[backend] = {'error': str(e)}
+                continue
+
+            outputs = result.pop('outputs')
+            if backend == 'eager':
+                reference_outputs = outputs
+            elif reference_outputs is not None:
+                result['quality'] = QUALITY_METRICS[model_name](reference_outputs, outputs)
+            model_results[backend] = result
+
+    print_report(results)
+    write_results(results, args.output, prefix='backends-')
+
+
+if __name__ == "__main__":
+    main()
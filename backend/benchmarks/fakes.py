@@ -0,0 +1,73 @@
+# Stand-ins for the models and the translation providers, so the benchmarks measure our own code on a CPU-only box
+import asyncio
+import hashlib
+import random
+import time
+import numpy as np
+
+from benchmarks.synthetic import make_words
+
+
+# LaMa stand-in for InPainter(model=...), keeps all of InPainter's pre/post-processing in the measurement
+class IdentityModel:
+    def __call__(self, image, mask):
+        # A real model returns a new tensor too
+        return image.clone()
+
+
+# Returns the ground truth boxes of the synthetic pages in the same format as BubbleDetector.detect
+class StubDetector:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def detect(self, image_list):
+        if self.latency:
+            time.sleep(self.latency * len(image_list))
+
+        results = []
+        for image in image_list:
+            # Pages may have been resized on the way, the boxes are scaled like the real detector does with target_sizes
+            page_width, page_height = image.info.get('synthetic_size', image.size)
+            scale = np.array([image.width / page_width, image.height / page_height] * 2)
+
+            boxes, labels = [], []
+            for bubble_box, text_box in image.info.get('synthetic_boxes', []):
+                boxes.extend([np.array(bubble_box) * scale, np.array(text_box) * scale])
+                labels.extend([0, 1])
+
+            results.append({
+                'boxes': np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+                'labels': np.asarray(labels, dtype=np.int64),
+                'scores': np.ones(len(labels), dtype=np.float32),
+            })
+        return results
+
+
+class StubOcr:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def extract_text_batch(self, crops, batch_size=None):
+        if self.latency:
+            time.sleep(self.latency * len(crops))
+        # Different text per crop so the rendering caches don't make every bubble free
+        return [f'{crop.width}x{crop.height}:{index}' for index, crop in enumerate(crops)]
+
+
+# Local translator with the TextTranslator interface, turns every line into English-looking words after a fixed latency
+class FakeTranslator:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.memory = None
+
+    async def translate_batch(self, texts, translator_option=None, fallback=True):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self.translate_line(text) for text in texts]
+
+    def translate_line(self, text):
+        seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+        return make_words(random.Random(seed), 2, 18)
+
+    async def aclose(self):
+        pass
@@ -0,0 +1,260 @@
+# Offline benchmark of the whole pipeline and of its CPU-heavy pieces, on synthetic pages with a local fake translator
+# Every suite runs in a fresh process so its peak RSS is its own, results are written to JSON to compare runs over time
+# Run from the backend directory: python -m benchmarks.run [--suites grouping rendering inpainting pipeline] [--models stub|real]
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+from benchmarks.synthetic import PAGE_SIZES
+
+SUITES = ['grouping', 'rendering', 'inpainting', 'pipeline']
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'count': int(samples.size),
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'mean': float(samples.mean()),
+    }
+
+
+def make_stage_samples():
+    from app.utils.metrics import StageTimings
+
+    # Keeps every observation instead of only the sums, for the percentiles
+    class StageSamples(StageTimings):
+        def __init__(self):
+            super().__init__()
+            self.samples = {}
+
+        def add(self, stage, seconds):
+            super().add(stage, seconds)
+            with self.lock:
+                self.samples.setdefault(stage, []).append(seconds)
+
+    return StageSamples()
+
+
+def build_pipeline(args):
+    from app import config
+    from app.core.pipeline import MangaTranslationPipeline
+    from benchmarks.fakes import FakeTranslator, IdentityModel, StubDetector, StubOcr
+
+    # Every run has to do the work, nothing can come from a previous one
+    config.STAGE_CACHE_ENABLED = False
+
+    translator = FakeTranslator(latency=args.translator_latency)
+    if args.models == 'real':
+        pipeline = MangaTranslationPipeline(translator=translator)
+        # Loading and warming up the models is not part of the measurement
+        pipeline.model_loader.wait_all()
+        return pipeline
+
+    from app.processing.inpainting import InPainter
+    return MangaTranslationPipeline(
+        detector=StubDetector(latency=args.model_latency),
+        ocr=StubOcr(latency=args.model_latency),
+        inpainter=InPainter(model=IdentityModel()),
+        translator=translator,
+    )
+
+
+def pages_for(args):
+    from benchmarks.synthetic import make_pages
+    return make_pages(args.seed, args.pages, args.size, args.min_bubbles, args.max_bubbles)
+
+
+# Grouping of the raw detections into bubbles, on detector-shaped random pages
+def run_grouping(args):
+    from app.utils.box_calculations import group_detections_batch
+    from benchmarks.bench_grouping import BUBBLE_MAP, make_page
+
+    rng = random.Random(args.seed)
+    raw_results = [make_page(rng, rng.randint(args.min_bubbles, args.max_bubbles) * 3) for _ in range(args.pages)]
+
+    samples = []
+    start = time.perf_counter()
+    for raw_result in raw_results:
+        page_start = time.perf_counter()
+        group_detections_batch([raw_result], BUBBLE_MAP, 0.3)
+        samples.append(time.perf_counter() - page_start)
+
+    return time.perf_counter() - start, {'grouping': samples}
+
+
+# Fitting and drawing the translated text of every bubble, with cold text layout caches
+def run_rendering(args):
+    from app.utils.render_box import get_font, layout_text, measure_line
+    from benchmarks.fakes import FakeTranslator
+
+    pipeline = build_pipeline(args)
+    translator = FakeTranslator()
+    pages = pages_for(args)
+
+    all_text_data = pipeline.detect_and_extract_text(pages)
+    for image_text_data in all_text_data.values():
+        for bubble in image_text_data.values():
+            bubble['translated_text'] = translator.translate_line(bubble['original_text'])
+
+    for cache in (get_font, layout_text, measure_line):
+        cache.cache_clear()
+
+    samples = []
+    start = time.perf_counter()
+    for image_index, page in enumerate(pages):
+        page_start = time.perf_counter()
+        pipeline.render_text({0: all_text_data[image_index]}, [page.copy()])
+        samples.append(time.perf_counter() - page_start)
+    elapsed = time.perf_counter() - start
+
+    pipeline.close()
+    return elapsed, {'rendering': samples}
+
+
+# Mask building, tiling, tensor conversions and pasting around the inpainter, the model itself is the identity with stub models
+def run_inpainting(args):
+    pipeline = build_pipeline(args)
+    pages = pages_for(args)
+    all_text_data = pipeline.detect_and_extract_text(pages)
+
+    samples = []
+    start = time.perf_counter()
+    for image_index, page in enumerate(pages):
+        page_start = time.perf_counter()
+        pipeline.inpaint_images({0: all_text_data[image_index]}, [page])
+        samples.append(time.perf_counter() - page_start)
+    elapsed = time.perf_counter() - start
+
+    pipeline.close()
+    return elapsed, {'inpainting': samples}
+
+
+# The whole request path through the page scheduler, every stage timed through the same metrics the server exports
+def run_pipeline(args):
+    from app.utils import metrics
+
+    pipeline = build_pipeline(args)
+    pages = pages_for(args)
+    stage_samples = make_stage_samples()
+
+    async def translate():
+        with metrics.collect_timings(stage_samples):
+            return await pipeline.translate_images(pages, 'fake')
+
+    start = time.perf_counter()
+    asyncio.run(translate())
+    elapsed = time.perf_counter() - start
+
+    pipeline.close()
+    return elapsed, stage_samples.samples
+
+
+SUITE_RUNNERS = {
+    'grouping': run_grouping,
+    'rendering': run_rendering,
+    'inpainting': run_inpainting,
+    'pipeline': run_pipeline,
+}
+
+
+def run_suite(suite, args):
+    elapsed, samples = SUITE_RUNNERS[suite](args)
+    return {
+        'pages': args.pages,
+        'seconds': elapsed,
+        'pagesPerSecond': args.pages / elapsed if elapsed else 0.0,
+        'peakRssMb': peak_rss_mb(),
+        'latency': {stage: summarize(stage_samples) for stage, stage_samples in samples.items()},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results):
+    print(f"{'suite':>12} {'pages/s':>9} {'peak RSS':>10}  stage latencies p50/p95 (ms)")
+    for suite, result in results['suites'].items():
+        stages = ', '.join(
+            f"{stage} {latency['p50'] * 1000:.1f}/{latency['p95'] * 1000:.1f}"
+            for stage, latency in result['latency'].items()
+        )
+        print(f"{suite:>12} {result['pagesPerSecond']:>9.2f} {result['peakRssMb']:>8.1f}MB  {stages}")
+
+
+def add_arguments(parser):
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=SUITES)
+    parser.add_argument('--models', choices=['stub', 'real'], default='stub', help="stub keeps the models out of the measurement, real loads the actual models")
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--size', choices=list(PAGE_SIZES), default='a4')
+    parser.add_argument('--min-bubbles', type=int, default=4)
+    parser.add_argument('--max-bubbles', type=int, default=16)
+    parser.add_argument('--model-latency', type=float, default=0.0, help="Seconds the stub detector and OCR sleep per page/crop")
+    parser.add_argument('--translator-latency', type=float, default=0.0, help="Seconds the fake translator sleeps per batch")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def run_metadata(args):
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'args': vars(args),
+    }
+
+
+def write_results(results, output=None, prefix=''):
+    output = output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f"{prefix}{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def run_suites(args):
+    context = multiprocessing.get_context('spawn')
+
+    results = {'meta': run_metadata(args), 'suites': {}}
+
+    for suite in args.suites:
+        with context.Pool(1) as pool:
+            results['suites'][suite] = pool.apply(run_suite, (suite, args))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument('--output', help="JSON file to write, benchmarks/results/<timestamp>.json by default")
+    args = parser.parse_args()
+
+    results = run_suites(args)
+    print_summary(results)
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Synthetic manga-like pages: screentone panels with speech bubbles full of text at varied sizes and densities
+# The boxes of every bubble are kept in image.info so the stub detector can return them without a model
+import random
+from PIL import Image, ImageDraw, ImageFont
+
+from app import config
+
+PAGE_SIZES = {
+    'small': (827, 1170),
+    'a4': (1654, 2339),
+    'spread': (3308, 2339),
+    '4k-spread': (3840, 2720),
+}
+
+WORDS = "the a of and to in is you that it he was for on are as with his they at be this have from or one had by word but not what all were we when your can said there use an each which she do how their if will up other about out many then them these so some her would make like him into time has look two more write go see number no way could people my than first water been call who oil its now find long down day did get come made may part".split()
+
+
+def make_words(rng, min_words, max_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def draw_panels(draw, rng, width, height):
+    rows = rng.randint(2, 4)
+    row_height = height // rows
+    for row in range(rows):
+        y1 = row * row_height + 20
+        y2 = (row + 1) * row_height - 20
+        columns = rng.randint(1, 3)
+        column_width = width // columns
+        for column in range(columns):
+            x1 = column * column_width + 20
+            x2 = (column + 1) * column_width - 20
+            draw.rectangle([x1, y1, x2, y2], outline=0, width=4)
+
+            # A few strokes of screentone so the inpainter has some texture to deal with
+            tone = rng.randint(150, 230)
+            for offset in range(0, (x2 - x1) + (y2 - y1), rng.randint(8, 20)):
+                draw.line([x1 + offset, y1, x1, y1 + offset], fill=(tone, tone, tone), width=1)
+
+
+def draw_bubble(draw, rng, width, height, font_path):
+    bubble_width = rng.randint(width // 10, width // 4)
+    bubble_height = rng.randint(height // 14, height // 5)
+    x1 = rng.randint(0, width - bubble_width)
+    y1 = rng.randint(0, height - bubble_height)
+    bubble_box = [x1, y1, x1 + bubble_width, y1 + bubble_height]
+    draw.ellipse(bubble_box, fill='white', outline='black', width=3)
+
+    # The text sits in the rectangle inscribed in the ellipse
+    margin_x, margin_y = int(bubble_width * 0.15), int(bubble_height * 0.15)
+    text_box = [x1 + margin_x, y1 + margin_y, x1 + bubble_width - margin_x, y1 + bubble_height - margin_y]
+
+    font_size = rng.randint(14, 40)
+    font = ImageFont.truetype(font_path, font_size)
+    line_y = text_box[1]
+    while line_y + font_size <= text_box[3]:
+        draw.text((text_box[0], line_y), make_words(rng, 1, 4), font=font, fill='black')
+        line_y += int(font_size * 1.2)
+
+    return bubble_box, text_box
+
+
+# One RGB page with num_bubbles bubbles, the ground truth boxes go in image.info['synthetic_boxes']
+def make_manga_page(rng, size='a4', num_bubbles=8, font_path=None):
+    width, height = PAGE_SIZES.get(size, size)
+    font_path = font_path or config.FONT_PATH
+
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    draw_panels(draw, rng, width, height)
+
+    boxes = [draw_bubble(draw, rng, width, height, font_path) for _ in range(num_bubbles)]
+
+    image.info['synthetic_size'] = (width, height)
+    image.info['synthetic_boxes'] = boxes
+    return image
+
+
+def make_pages(seed, count, size='a4', min_bubbles=4, max_bubbles=16):
+    rng = random.Random(seed)
+    return [make_manga_page(rng, size, rng.randint(min_bubbles, max_bubbles)) for _ in range(count)]